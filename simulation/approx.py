@@ -1,7 +1,7 @@
 import numpy as np
-import statsmodels.api as sm
 from collections import defaultdict
 from validation import data_preparation
+from surrogate import FeatureBuilder, minmax_scale, add_constant, fit_sparse, summary_table
 
 # load random generated decision and corresponding simulation output
 with open("data/sim-output.txt", "r") as f:
@@ -16,37 +16,27 @@ with open("data/sim-output.txt", "r") as f:
 # load data
 beat_info, mu, t_beats, Tau, d_beats, Dist, _ = data_preparation()
 
-X = []
-Y = []
-for n in range(len(ds)):
-    # load decision into a vector
-    year, beats = ds[n][0], ds[n][1]
-    # load workload
-    w           = sum([ beat_info[beat][year]["count"] for beat in beats ]) * mu
-    # construct Y
-    y           = ws[n] - w
-    # construct X
-    x           = [ 0 for i in range(len(t_beats) - 10) ] # remove last 10 beats (zone 7)
-    for beat in beats:
-        x[t_beats.index(beat)] = beat_info[beat][year]["count"] * Tau[t_beats.index(beat),:].sum()
-
-    X.append(x)
-    Y.append(y)
+# construct X (the workload of each beat of the decision weighted by the total travel time from 
+# the beat) as a sparse matrix, where the last 10 beats (zone 7) are removed
+builder = FeatureBuilder(t_beats, n_cols=len(t_beats) - 10)
+tau_sum = Tau.sum(axis=1)
+t_idx   = { beat: i for i, beat in enumerate(t_beats) }
+Etas    = [ beat_info.count(beats, year) for year, beats in ds ]
+X       = builder.weighted([ beats for year, beats in ds ], 
+    [ eta * tau_sum[[ t_idx[beat] for beat in beats ]] for (year, beats), eta in zip(ds, Etas) ])
+# construct Y (the workload beyond the service time)
+Y       = np.array(ws) - np.array([ eta.sum() * mu for eta in Etas ])
 
 # linear regression model
-X       = np.array(X)
-X       = (X - X.min()) / (X.max() - X.min())
-Y       = np.array(Y)
+X, _, _ = minmax_scale(X)
 Y       = (Y - Y.min()) / (Y.max() - Y.min())
 
-X       = sm.add_constant(X)
-model   = sm.OLS(Y,X)
-results = model.fit()
-print(results.summary())
-print(results.mse_total)
+X       = add_constant(X)
+W, results = fit_sparse(X, Y, inference=True)
+print(summary_table(results, t_beats[:builder.n_cols] + ["const"]))
 
 # fig, ax = plt.subplots(figsize=(12, 8))
-# fig = sm.graphics.plot_fit(results, "x1", ax=ax)
+# fig = sm.graphics.plot_fit(sm.OLS(Y, X.toarray()).fit(), "x1", ax=ax)
 # plt.show()
 
 import branca
@@ -72,8 +62,8 @@ def plot_vals_on_map(val_vec, name, path):
     # map initialization
     _map     = folium.Map(location=center, zoom_start=13, zoom_control=True, max_zoom=17, min_zoom=10)
     # continuous color map intialization
-    print(min(val_vec[1:]), max(val_vec[1:]))
-    cm       = branca.colormap.linear.YlOrRd_09.scale(min(val_vec[1:]), max(val_vec[1:])) # colorbar for values
+    print(min(val_vec), max(val_vec))
+    cm       = branca.colormap.linear.YlOrRd_09.scale(min(val_vec), max(val_vec)) # colorbar for values
     cm.caption = name
     folium.GeoJson(
         data = open("/Users/woodie/Desktop/workspace/Zoning-Analysis/data/geodata/apd_beat.geojson").read(),
@@ -87,7 +77,8 @@ def plot_vals_on_map(val_vec, name, path):
     # save the map
     _map.save(path)
 
-# plot_vals_on_map(results.params, "coef", "params.html")
-# plot_vals_on_map(results.tvalues, "t-values", "tvalues.html")
-# plot_vals_on_map(results.pvalues, "p-values", "pvalues.html")
-# plot_vals_on_map(results.bse, "std error", "stderror.html")
\ No newline at end of file
+# the values of the beats (the constant is the last feature)
+# plot_vals_on_map(results["params"][:-1], "coef", "params.html")
+# plot_vals_on_map(results["tvalues"][:-1], "t-values", "tvalues.html")
+# plot_vals_on_map(results["pvalues"][:-1], "p-values", "pvalues.html")
+# plot_vals_on_map(results["bse"][:-1], "std error", "stderror.html")
\ No newline at end of file
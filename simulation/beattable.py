@@ -0,0 +1,81 @@
+import numpy as np
+
+
+
+class BeatYearTable(object):
+    """
+    Table of the Workload and the Number of 911 Calls per Beat per Year
+
+    The counts and workloads are kept in dense (beats x years) arrays along with the index maps of
+    the beats and years, so that the vector of a zone (a list of beats) in one or several years is
+    selected in one step, e.g.,
+
+        Eta  = beat_info.count(beats, "2017")          # (n_beats,)
+        Etas = beat_info.count(beats, years)           # (n_beats, n_years)
+
+    Beats or years out of the table have zero count and workload. Beats are kept in the order of
+    their first appearance in the calls, which defines the order of the zones of the current design.
+    """
+
+    def __init__(self, beats, years, count, workload):
+        """
+        Params:
+        * beats:    list of beat names,
+        * years:    list of years (strings),
+        * count:    (n_beats x n_years) number of calls,
+        * workload: (n_beats x n_years) total workload in seconds.
+        """
+        self.beats    = list(beats)
+        self.years    = list(years)
+        self.beat_idx = { beat: i for i, beat in enumerate(self.beats) }
+        self.year_idx = { year: j for j, year in enumerate(self.years) }
+        # an extra zero row and column for the beats and years out of the table
+        shape         = (len(self.beats) + 1, len(self.years) + 1)
+        self._count   = np.zeros(shape, dtype=np.int64)
+        self._load    = np.zeros(shape, dtype=np.float64)
+        self._count[:-1, :-1] = count
+        self._load[:-1, :-1]  = workload
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Build the table from the arrays `beats`, `years`, `count` and `workload`."""
+        return cls(arrays["beats"].tolist(), arrays["years"].tolist(), arrays["count"], arrays["workload"])
+
+    def __len__(self):
+        return len(self.beats)
+
+    def __iter__(self):
+        return iter(self.beats)
+
+    def __contains__(self, beat):
+        return beat in self.beat_idx
+
+    def beat_index(self, beats):
+        """Return the row indices of the beats."""
+        return np.array([ self.beat_idx.get(beat, len(self.beats)) for beat in beats ], dtype=np.int64)
+
+    def year_index(self, years):
+        """Return the column index (or indices) of the year (or list of years)."""
+        if isinstance(years, str):
+            return self.year_idx.get(years, len(self.years))
+        return np.array([ self.year_idx.get(year, len(self.years)) for year in years ], dtype=np.int64)
+
+    def select(self, field, beats, years):
+        """
+        Return the `count` or `workload` of the beats in the year, i.e., a vector of length
+        `len(beats)`, or in the list of years, i.e., a (len(beats) x len(years)) matrix.
+        """
+        table = { "count": self._count, "workload": self._load }[field]
+        rows  = self.beat_index(beats)
+        cols  = self.year_index(years)
+        if isinstance(years, str):
+            return table[rows, cols]
+        return table[np.ix_(rows, cols)]
+
+    def count(self, beats, years):
+        """Return the number of calls of the beats in the year(s)."""
+        return self.select("count", beats, years)
+
+    def workload(self, beats, years):
+        """Return the total workload of the beats in the year(s)."""
+        return self.select("workload", beats, years)
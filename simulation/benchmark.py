@@ -0,0 +1,163 @@
+"""
+Phase-level benchmark of the hypercube queueing model.
+
+Run `HypercubeQ` over a grid of zone sizes, line capacities and random seeds, and record the wall
+time and the peak memory of each phase of the model construction. The results are written as JSON
+and CSV files tagged with the current git commit, so that runs can be compared across commits, e.g.,
+
+    python benchmark.py --sizes 5 10 15 20 --seeds 0 1 2 --output bench-new
+    python benchmark.py --sizes 5 10 15 20 --seeds 0 1 2 --output bench-old --baseline bench-new.json
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from collections import defaultdict
+from hypercubeq import HypercubeQ, state_tables
+
+# phases of the model construction in the order of execution
+PHASES = {
+    "exact":  ["_tour", "_upward_transition_rates", "_steady_state_probs", "_dispatch_fraction", "_average_travel_time"],
+    "approx": ["_busy_level_probs", "_approx_busy_probs", "_dispatch_fraction", "_average_travel_time"]
+}
+
+
+
+class ProfiledHypercubeQ(HypercubeQ):
+    """
+    Hypercube queueing model that records the wall time (seconds) and the peak memory (bytes
+    allocated on top of the memory in use when the phase starts) of each phase in `profile`.
+    """
+
+    def __init__(self, *args, trace_memory=True, **kwargs):
+        self.profile      = {}
+        self.trace_memory = trace_memory
+        super().__init__(*args, **kwargs)
+
+    def _run_phase(self, name, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_mem = tracemalloc.get_traced_memory()[0]
+        start_t = time.perf_counter()
+        result  = getattr(HypercubeQ, name)(self, *args, **kwargs)
+        wall_t  = time.perf_counter() - start_t
+        peak    = tracemalloc.get_traced_memory()[1] - start_mem if self.trace_memory else None
+        self.profile[name] = { "wall_time": wall_t, "peak_memory": peak }
+        return result
+
+def _profiled(name):
+    def phase(self, *args, **kwargs):
+        return self._run_phase(name, *args, **kwargs)
+    phase.__name__ = name
+    return phase
+
+for _name in set(sum(PHASES.values(), [])):
+    setattr(ProfiledHypercubeQ, _name, _profiled(_name))
+
+
+
+def git_commit():
+    """Return the current git commit of the repository (None if unavailable)."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes, caps, seeds, method="exact", solver="gauss-seidel", trace_memory=True):
+    """
+    Run the benchmark over the grid of sizes, line capacities and seeds, and return a list of
+    records with one record per (N, cap, seed, phase), plus a `total` phase for the whole model.
+    """
+    commit  = git_commit()
+    records = []
+    if trace_memory:
+        tracemalloc.start()
+    for n_atoms in sizes:
+        for cap in caps:
+            for seed in seeds:
+                # the tables of the state space are cached per size, which would hide the cost of the tour
+                state_tables.cache_clear()
+                np.random.seed(seed)
+                start_t = time.perf_counter()
+                hq      = ProfiledHypercubeQ(n_atoms, cap=cap, method=method, solver=solver, trace_memory=trace_memory)
+                total_t = time.perf_counter() - start_t
+                profile = dict(hq.profile, total={
+                    "wall_time":   total_t,
+                    "peak_memory": max([ p["peak_memory"] for p in hq.profile.values() ]) if trace_memory else None })
+                for phase in PHASES[method] + ["total"]:
+                    records.append({
+                        "commit": commit, "method": method, "solver": solver, "n_atoms": n_atoms, "cap": cap,
+                        "seed": seed, "phase": phase, "n_iter": hq.n_iter, "residual": float(hq.residual), 
+                        "converged": bool(hq.converged),
+                        "wall_time": profile[phase]["wall_time"], "peak_memory": profile[phase]["peak_memory"] })
+                print("N=%2d cap=%-4s seed=%d total %.4fs (%d iterations, residual %.2e%s)" % (n_atoms, cap, seed, 
+                    total_t, hq.n_iter, hq.residual, "" if hq.converged else ", NOT CONVERGED"), file=sys.stderr)
+    if trace_memory:
+        tracemalloc.stop()
+    return records
+
+def summarize(records):
+    """
+    Return the median wall time, the peak memory, the median number of iterations and the fraction 
+    of converged runs of each (N, cap, phase) over seeds.
+    """
+    groups = defaultdict(list)
+    for r in records:
+        groups[(r["n_atoms"], r["cap"], r["phase"])].append(r)
+    summary = {}
+    for key, rs in groups.items():
+        peaks        = [ r["peak_memory"] for r in rs if r["peak_memory"] is not None ]
+        summary[key] = (np.median([ r["wall_time"] for r in rs ]), np.median(peaks) if len(peaks) > 0 else np.nan,
+            np.median([ r["n_iter"] for r in rs ]), np.mean([ r.get("converged", True) for r in rs ]))
+    return summary
+
+def report(records, baseline=None):
+    """Print the summary table, and the speedup over the baseline records if specified."""
+    summary      = summarize(records)
+    base_summary = summarize(baseline) if baseline is not None else {}
+    print("%4s %-4s %-26s %12s %12s %8s %10s %10s" % ("N", "cap", "phase", "time (s)", "peak (MB)", "n_iter", "converged", "speedup"))
+    for key in sorted(summary.keys(), key=lambda k: (k[0], k[1])):
+        wall_t, peak, n_iter, converged = summary[key]
+        speedup = base_summary[key][0] / wall_t if key in base_summary and wall_t > 0 else np.nan
+        print("%4d %-4s %-26s %12.6f %12.3f %8d %9.0f%% %10.2f" % (key[0], key[1], key[2], wall_t, peak / 2 ** 20, 
+            n_iter, converged * 100, speedup))
+
+def save(records, output):
+    """Write the records to `<output>.json` and `<output>.csv`."""
+    with open("%s.json" % output, "w") as f:
+        json.dump({ "python": platform.python_version(), "numpy": np.__version__, "records": records }, f, indent=1)
+    with open("%s.csv" % output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(records[0].keys()))
+        writer.writeheader()
+        writer.writerows(records)
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phase-level benchmark of HypercubeQ.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(range(5, 21)), help="numbers of atoms N")
+    parser.add_argument("--caps", nargs="+", default=["zero", "inf"], choices=["zero", "inf"], help="line capacities")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2], help="random seeds of the model inputs")
+    parser.add_argument("--method", default="exact", choices=["exact", "approx"])
+    parser.add_argument("--solver", default="gauss-seidel", choices=["jacobi", "gauss-seidel", "direct"])
+    parser.add_argument("--no-memory", action="store_true", help="disable tracemalloc (and peak memory)")
+    parser.add_argument("--output", default="bench_hypercubeq", help="prefix of the JSON/CSV result files")
+    parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    records  = run(args.sizes, args.caps, args.seeds, method=args.method, solver=args.solver,
+        trace_memory=not args.no_memory)
+    save(records, args.output)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["records"]
+    report(records, baseline)
@@ -0,0 +1,110 @@
+"""
+Streaming results and checkpoints of long design-evaluation runs.
+
+The results are appended to a partial output file as each design is evaluated, and every
+`flush_every` designs the file is flushed to disk and a checkpoint is written with the number of
+designs done and the state of the run (e.g., the random states used to generate the designs), so
+that an interrupted run can be resumed without re-evaluating the finished designs.
+"""
+
+import os
+import json
+import random
+import hashlib
+import numpy as np
+
+
+
+def rng_state():
+    """Return the states of the random generators of Python and NumPy (JSON-serializable)."""
+    np_state = np.random.get_state()
+    return {
+        "random": [ random.getstate()[0], list(random.getstate()[1]), random.getstate()[2] ],
+        "numpy":  [ np_state[0], np_state[1].tolist(), int(np_state[2]), int(np_state[3]), float(np_state[4]) ] }
+
+def set_rng_state(state):
+    """Restore the states of the random generators of Python and NumPy."""
+    version, internal, gauss_next = state["random"]
+    random.setstate((version, tuple(internal), gauss_next))
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+
+def designs_hash(designs):
+    """Return the hash of a list of designs, which identifies the designs of a run."""
+    return hashlib.sha1(json.dumps([ dict(design) for design in designs ]).encode()).hexdigest()
+
+def load_checkpoint(path):
+    """Return the checkpoint (None if there is no checkpoint)."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically."""
+    tmp_path = path + ".%d.tmp" % os.getpid()
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+def read_rows(path):
+    """Return the rows (lists of strings) of a comma-separated results file."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [ line.strip("\n").split(",") for line in f if line.strip("\n") != "" ]
+
+
+
+class ResultWriter(object):
+    """
+    Streaming Writer of Results with Checkpoints
+
+    Each row is appended to the results file as it completes. When resuming from a checkpoint,
+    the rows written after the last checkpoint (if the run was interrupted in between) are
+    dropped, so that the results file always agrees with the checkpoint.
+    """
+
+    def __init__(self, path, checkpoint_path, state, n_done=0, flush_every=10):
+        """
+        Params:
+        * path:            path of the results file,
+        * checkpoint_path: path of the checkpoint,
+        * state:           JSON-serializable state of the run recorded in the checkpoint,
+        * n_done:          number of rows already done (0 if not resuming),
+        * flush_every:     number of rows between two checkpoints.
+        """
+        rows = read_rows(path)[:n_done]
+        assert len(rows) == n_done, "the results file has fewer rows than its checkpoint"
+        self.path            = path
+        self.checkpoint_path = checkpoint_path
+        self.state           = state
+        self.n_done          = n_done
+        self.flush_every     = flush_every
+        # rewrite the kept rows to a temporary file first so that an interruption never loses them
+        tmp_path             = path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as f:
+            for row in rows:
+                f.write("%s\n" % ",".join(row))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.f               = open(path, "a")
+        self.flush()
+
+    def write(self, row):
+        """Append a row (list of strings)."""
+        self.f.write("%s\n" % ",".join(row))
+        self.n_done += 1
+        if self.n_done % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        """Flush the rows to disk and record the checkpoint."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        save_checkpoint(self.checkpoint_path, dict(self.state, n_done=self.n_done))
+
+    def close(self):
+        self.flush()
+        self.f.close()
@@ -0,0 +1,251 @@
+"""
+Binary columnar cache of the parsed input data.
+
+The cache stores named groups of arrays (e.g., the parsed columns of the 911 calls, or the workload
+and the number of calls per beat per year derived from them) as one `.npy` file per array, which are
+loaded as read-only memory maps. Each group is described by a JSON manifest together with the 
+fingerprints (size, modification time and SHA-1 hash) of the source files it was derived from, so 
+that the group is rebuilt as soon as any of its sources changes, e.g.,
+
+    cache    = DataCache("../data/cache/preparation")
+    calls    = cache.fetch("calls", ["../data/rawdata/911.calls.concise.txt"], build=parse_calls)
+    workload = cache.fetch("beat_workload", ["../data/rawdata/911.calls.concise.txt"], 
+        build=lambda: beat_workload(call_chunks(calls)))
+
+Matrices indexed by beats (e.g., the travel time and distance matrices) are kept in a content-
+addressed store instead, keyed by the hashes of their source files and the parameters they are
+built with (e.g., the imputation strategy or the distance metric), e.g.,
+
+    store         = MatrixStore("../data/cache/matrices")
+    d_beats, Dist = store.fetch("dist", ["../data/beats_centroids.csv"], { "metric": "manhattan" },
+        build=lambda: travel_time_from_distance(metric="manhattan"))
+
+Both are fetched the same way, i.e., `fetch(name, sources, params=None, *, build)`.
+"""
+
+import os
+import sys
+import json
+import shutil
+import arrow
+import hashlib
+import numpy as np
+
+# bump to invalidate the existing caches when the layout of the cached arrays changes
+CACHE_VERSION = 1
+
+
+
+def file_hash(path, block_size=2 ** 20):
+    """Return the SHA-1 hash of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def fingerprint(path, with_hash=True):
+    """Return the size, the modification time and (optionally) the hash of a file."""
+    stat = os.stat(path)
+    return {
+        "size":     stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha1":     file_hash(path) if with_hash else None }
+
+
+
+class DataCache(object):
+    """
+    Cache of Named Groups of Arrays Derived from Source Files
+
+    A group is fresh if each of its sources has the recorded size and either the recorded
+    modification time or, if the file was only touched, the recorded hash. The hash is only
+    computed when the modification times differ, so that warm starts never read the sources.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        Params:
+        * cache_dir: directory of the cache (one sub-directory per group).
+        """
+        self.cache_dir = cache_dir
+        self.hits, self.misses = 0, 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def fetch(self, name, sources, params=None, *, build):
+        """
+        Return the arrays (a dict of name -> array) of the group `name` from the cache if it is
+        fresh, otherwise build them by calling `build()` and store them in the cache. `params` is
+        an optional JSON-serializable dict of the parameters the arrays depend on.
+        """
+        arrays = self.load(name, sources, params)
+        if arrays is not None:
+            self.hits += 1
+            return arrays
+        self.misses += 1
+        print("[%s] building cached data `%s`" % (arrow.now(), name), file=sys.stderr)
+        arrays = { key: np.asarray(value) for key, value in build().items() }
+        self.save(name, sources, arrays, params)
+        return arrays
+
+    def _dir(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def _manifest_path(self, name):
+        return os.path.join(self._dir(name), "manifest.json")
+
+    def is_fresh(self, name, sources, params=None):
+        """Return the manifest of the group if it is fresh, otherwise None."""
+        if not os.path.exists(self._manifest_path(name)):
+            return None
+        with open(self._manifest_path(name)) as f:
+            manifest = json.load(f)
+        if manifest["version"] != CACHE_VERSION or manifest["params"] != params or \
+            sorted(manifest["sources"].keys()) != sorted(sources):
+            return None
+        touched = False
+        for path in sources:
+            if not os.path.exists(path):
+                return None
+            recorded = manifest["sources"][path]
+            current  = fingerprint(path, with_hash=False)
+            if current["size"] != recorded["size"]:
+                return None
+            if current["mtime_ns"] != recorded["mtime_ns"]:
+                # the file was modified or only touched, which is told apart by its content
+                if file_hash(path) != recorded["sha1"]:
+                    return None
+                recorded["mtime_ns"] = current["mtime_ns"]
+                touched              = True
+        if touched:
+            self._write_manifest(name, manifest)
+        return manifest
+
+    def load(self, name, sources, params=None):
+        """Return the arrays of the group as read-only memory maps if it is fresh, otherwise None."""
+        manifest = self.is_fresh(name, sources, params)
+        if manifest is None:
+            return None
+        return { key: np.load(os.path.join(self._dir(name), "%s.npy" % key), mmap_mode="r")
+            for key in manifest["arrays"] }
+
+    def save(self, name, sources, arrays, params=None):
+        """Store the arrays of the group along with the fingerprints of its sources."""
+        os.makedirs(self._dir(name), exist_ok=True)
+        # invalidate the group first so that an interrupted save is never mistaken for a fresh one
+        if os.path.exists(self._manifest_path(name)):
+            os.remove(self._manifest_path(name))
+        for key, value in arrays.items():
+            assert value.dtype != object, "object array `%s` cannot be memory-mapped" % key
+            path = os.path.join(self._dir(name), "%s.npy" % key)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, value)
+            os.replace(path + ".tmp", path)
+        self._write_manifest(name, {
+            "version": CACHE_VERSION,
+            "params":  params,
+            "sources": { path: fingerprint(path) for path in sources },
+            "arrays":  { key: { "dtype": value.dtype.str, "shape": list(value.shape) }
+                for key, value in arrays.items() } })
+
+    def _write_manifest(self, name, manifest):
+        tmp_path = self._manifest_path(name) + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self._manifest_path(name))
+
+
+
+class MatrixStore(object):
+    """
+    Content-addressed Store of Matrices Indexed by Beats
+
+    Each matrix is stored with its list of beats in a directory named after its key, i.e., the hash
+    of the contents of its source files and of its parameters, so that the matrices built from other
+    inputs or parameters never collide and are rebuilt (under a new key) as soon as an input changes. 
+    The hashes of the source files are remembered by size and modification time, so that a warm 
+    start never reads the sources, and the matrices are loaded as read-only memory maps (zero-copy).
+    The least recently used entries are evicted once the store exceeds `max_bytes`.
+    """
+
+    def __init__(self, store_dir, max_bytes=2 ** 32):
+        """
+        Params:
+        * store_dir: directory of the store (one sub-directory per matrix),
+        * max_bytes: maximum total size of the matrices kept in the store.
+        """
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def _hash_index_path(self):
+        return os.path.join(self.store_dir, "sources.json")
+
+    def source_hash(self, path):
+        """Return the hash of the content of a source file (remembered by its size and mtime)."""
+        index = {}
+        if os.path.exists(self._hash_index_path()):
+            with open(self._hash_index_path()) as f:
+                index = json.load(f)
+        stat   = os.stat(path)
+        record = index.get(os.path.abspath(path))
+        if record is not None and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+            return record["sha1"]
+        index[os.path.abspath(path)] = { "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": file_hash(path) }
+        tmp_path = self._hash_index_path() + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp_path, self._hash_index_path())
+        return index[os.path.abspath(path)]["sha1"]
+
+    def key(self, name, sources, params=None):
+        """Return the key of the matrix given the hashes of its sources and its parameters."""
+        content = json.dumps({ "version": CACHE_VERSION, "name": name, "params": params, 
+            "sources": [ self.source_hash(path) for path in sources ] }, sort_keys=True)
+        return "%s-%s" % (name, hashlib.sha1(content.encode()).hexdigest())
+
+    def fetch(self, name, sources, params=None, *, build):
+        """
+        Return the beats and the matrix of the key from the store if available, otherwise build 
+        them by calling `build()` (which returns the list of beats and the matrix) and store them.
+        `params` is an optional JSON-serializable dict of the parameters the matrix depends on.
+        """
+        entry_dir = os.path.join(self.store_dir, self.key(name, sources, params))
+        if os.path.exists(os.path.join(entry_dir, "matrix.npy")):
+            self.hits += 1
+            os.utime(entry_dir)                          # mark as recently used
+            beats = np.load(os.path.join(entry_dir, "beats.npy")).tolist()
+            return beats, np.load(os.path.join(entry_dir, "matrix.npy"), mmap_mode="r")
+        self.misses += 1
+        print("[%s] building stored matrix `%s`" % (arrow.now(), name), file=sys.stderr)
+        beats, matrix = build()
+        self.save(entry_dir, beats, matrix, { "name": name, "params": params, "sources": sources })
+        return list(beats), matrix
+
+    def save(self, entry_dir, beats, matrix, meta):
+        """Write the entry to a temporary directory first, which is then renamed to the entry."""
+        tmp_dir = entry_dir + ".%d.tmp" % os.getpid()
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, "beats.npy"), np.array(beats, dtype=str))
+        np.save(os.path.join(tmp_dir, "matrix.npy"), np.asarray(matrix))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:                                  # stored by a concurrent run in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the store fits in `max_bytes`."""
+        entries = [ os.path.join(self.store_dir, d) for d in os.listdir(self.store_dir) 
+            if os.path.isdir(os.path.join(self.store_dir, d)) and not d.endswith(".tmp") ]
+        sizes   = { entry: sum([ os.path.getsize(os.path.join(entry, fname)) for fname in os.listdir(entry) ]) 
+            for entry in entries }
+        entries.sort(key=os.path.getmtime)
+        n_bytes = sum(sizes.values())
+        while n_bytes > self.max_bytes and len(entries) > 1:
+            entry    = entries.pop(0)
+            n_bytes -= sizes[entry]
+            shutil.rmtree(entry, ignore_errors=True)
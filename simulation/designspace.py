@@ -0,0 +1,173 @@
+"""
+Compact representation of zone designs and their neighbourhoods.
+
+A design is encoded as an integer array mapping each beat (in the order of the beats graph) to the
+index of its zone (-1 if the beat is not assigned), along with the rank of each beat in the beat
+list of its zone. Two designs are adjacent if they differ by moving one boundary beat into an
+adjacent zone, so a neighbourhood is enumerated as moves `(beat, from_zone, to_zone)` applied to
+and undone from a single design in place, and full designs (dicts of zone -> list of beats) are
+only materialized when needed.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+
+
+def load_beats_graph(path="../data/beats_graph.csv"):
+    """Return the beats and their adjacency matrix (scipy.sparse CSR) in the beats graph file."""
+    with open(path) as f:
+        data      = list(f)
+        all_beats = [ beat.strip('"') for beat in data[0].strip("\n").split(",")[1:] ]
+        graph     = np.zeros((len(all_beats), len(all_beats)))
+        for i in range(1, len(data)):
+            graph[i-1, :] = np.array([ int(d.strip('"')) for d in data[i].strip("\n").split(",")[1:] ])
+    return all_beats, sp.csr_matrix(graph == 1)
+
+
+
+class Design(object):
+    """
+    Design Encoded as Arrays
+
+    `zone_of[b]` is the zone index of beat `b` (-1 if unassigned), and `rank[b]` orders the beats
+    within a zone, where a beat moved into a zone is ranked last (i.e., appended to its list).
+    """
+
+    def __init__(self, zone_of, rank):
+        self.zone_of   = zone_of
+        self.rank      = rank
+        self.next_rank = int(rank.max()) + 1 if len(rank) > 0 else 0
+
+    def copy(self):
+        return Design(self.zone_of.copy(), self.rank.copy())
+
+    def key(self):
+        """Return a hashable key of the assignment of beats to zones."""
+        return self.zone_of.tobytes()
+
+    def members(self, zone):
+        """Return the beat indices of the zone in the order of the beat list of the zone."""
+        beats = np.flatnonzero(self.zone_of == zone)
+        return beats[np.argsort(self.rank[beats], kind="stable")]
+
+    def apply(self, move):
+        """Apply the move in place and return the token to undo it."""
+        beat, from_zone, to_zone = move
+        token                    = (beat, from_zone, self.rank[beat], self.next_rank)
+        self.zone_of[beat]       = to_zone
+        self.rank[beat]          = self.next_rank
+        self.next_rank          += 1
+        return token
+
+    def undo(self, token):
+        """Undo a move applied in place given its token."""
+        beat, from_zone, rank, next_rank = token
+        self.zone_of[beat] = from_zone
+        self.rank[beat]    = rank
+        self.next_rank     = next_rank
+
+
+
+class DesignSpace(object):
+    """
+    Space of Zone Designs over the Beats Graph
+
+    Moves into the fixed zones (zone 7 by default) are not considered, while beats can still be
+    moved out of them, as in the original neighbourhood definition.
+    """
+
+    def __init__(self, beats, adjacency, zones, fixed_zones=("7",)):
+        """
+        Params:
+        * beats:       list of beats of the beats graph,
+        * adjacency:   (n_beats x n_beats) adjacency matrix of the beats (scipy.sparse),
+        * zones:       list of zone names,
+        * fixed_zones: zones that no beat can be moved into.
+        """
+        self.beats       = list(beats)
+        self.beat_idx    = { beat: i for i, beat in enumerate(self.beats) }
+        self.adjacency   = sp.csr_matrix(adjacency)
+        self.adjacency.sort_indices()
+        self.zones       = list(zones)
+        self.zone_idx    = { zone: z for z, zone in enumerate(self.zones) }
+        self.fixed_zones = [ self.zone_idx[zone] for zone in fixed_zones if zone in self.zone_idx ]
+
+    @classmethod
+    def from_graph(cls, zones, path="../data/beats_graph.csv", fixed_zones=("7",)):
+        beats, adjacency = load_beats_graph(path)
+        return cls(beats, adjacency, zones, fixed_zones)
+
+    def neighbors(self, beat):
+        """Return the indices of the adjacent beats of a beat (in the order of the beats graph)."""
+        return self.adjacency.indices[self.adjacency.indptr[beat]:self.adjacency.indptr[beat+1]]
+
+    def encode(self, design):
+        """Encode a design (dict of zone -> list of beats)."""
+        zone_of = np.full(len(self.beats), -1, dtype=np.int32)
+        rank    = np.zeros(len(self.beats), dtype=np.int64)
+        n       = 0
+        for zone, beats in design.items():
+            for beat in beats:
+                b          = self.beat_idx[beat]
+                zone_of[b] = self.zone_idx[zone]
+                rank[b]    = n
+                n         += 1
+        return Design(zone_of, rank)
+
+    def decode(self, state):
+        """Return the design (dict of zone -> list of beats) of an encoded design."""
+        return { zone: [ self.beats[b] for b in state.members(z) ] for z, zone in enumerate(self.zones) }
+
+    def moves(self, state):
+        """
+        Yield the moves `(beat, from_zone, to_zone)` to the adjacent designs, i.e., for each zone
+        (except for the fixed zones), each beat of another zone adjacent to one of its beats is
+        moved into the zone once.
+        """
+        for z in range(len(self.zones)):
+            if z in self.fixed_zones:
+                continue
+            moved = set()
+            for beat in state.members(z):
+                for nbeat in self.neighbors(beat):
+                    nzone = state.zone_of[nbeat]
+                    if nzone != z and nzone >= 0 and nbeat not in moved:
+                        moved.add(nbeat)
+                        yield (int(nbeat), int(nzone), z)
+
+    def materialize(self, design, move):
+        """
+        Return the design (dict of zone -> list of beats) after the move, where only the lists of
+        the two zones of the move are copied and the others are shared with `design`.
+        """
+        beat, from_zone, to_zone = move
+        beat, from_zone, to_zone = self.beats[beat], self.zones[from_zone], self.zones[to_zone]
+        adj_design               = design.copy()
+        adj_design[to_zone]      = design[to_zone] + [beat]
+        adj_design[from_zone]    = [ b for b in design[from_zone] if b != beat ]
+        return adj_design
+
+    def neighbourhood(self, state, depth, unique=True):
+        """
+        Yield the sequences of moves (tuples) of up to `depth` steps from the design by depth-first
+        search, where `state` is updated in place to the design after each sequence when it is
+        yielded and restored at the end. If `unique`, each design is reached only once.
+        """
+        seen = { state.key() } if unique else None
+        path = []
+
+        def walk(level):
+            for move in list(self.moves(state)):
+                token = state.apply(move)
+                if seen is None or state.key() not in seen:
+                    if seen is not None:
+                        seen.add(state.key())
+                    path.append(move)
+                    yield tuple(path)
+                    if level < depth:
+                        yield from walk(level + 1)
+                    path.pop()
+                state.undo(token)
+
+        yield from walk(1)
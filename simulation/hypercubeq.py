@@ -1,8 +1,153 @@
+import os
 import sys
-import math
 import arrow
+import hashlib
+import tracing
+import warnings
 import numpy as np
-from collections import defaultdict
+import scipy.sparse as sp
+from functools import lru_cache
+from collections import OrderedDict
+from scipy.sparse.linalg import spsolve
+from scipy.special import comb, gammaln, logsumexp
+
+@lru_cache(maxsize=8)
+def state_tables(n_atoms):
+    """
+    Return the tables of the hypercube state space with N = `n_atoms` units, which only depend on N 
+    and are shared by all the models of the same size:
+    * codes:    uint32 bitmask code of each state in the unit-step tour (bit n is set iff unit n is busy),
+    * pos:      uint32 tour position of each state code,
+    * popcount: uint8 number of busy units of each state code,
+    * trailing: uint8 number of trailing ones of each state code.
+    All the tables take O(2^N) memory and are built by doubling the tables of N-1 units.
+    """
+    codes    = np.arange(2 ** n_atoms, dtype=np.uint32)
+    codes   ^= codes >> 1
+    pos      = np.empty(2 ** n_atoms, dtype=np.uint32)
+    pos[codes] = np.arange(2 ** n_atoms, dtype=np.uint32)
+    popcount = np.zeros(1, dtype=np.uint8)
+    trailing = np.zeros(1, dtype=np.uint8)
+    for n in range(n_atoms):
+        popcount = np.concatenate([popcount, popcount + 1])
+        trailing = np.concatenate([trailing, trailing])
+        trailing[-1] += 1
+    for table in [codes, pos, popcount, trailing]:
+        table.setflags(write=False)
+    return codes, pos, popcount, trailing
+
+class StructureCache(object):
+    """
+    LRU Cache for the Structure of Hypercube Queueing Models
+
+    Everything computed before the steady-state solve (the optimal dispatched units, and thus the 
+    upward optimal neighbors and the optimal dispatch state sets) only depends on the preference 
+    matrix `P`. The cache keeps these tables in memory keyed by a hash of `P`, and optionally in an 
+    on-disk store (one `.npy` file per key, loaded as a read-only memory map) shared across runs. 
+    Both levels evict the least recently used tables once they exceed their size bound in bytes.
+    """
+
+    def __init__(self, max_bytes=2 ** 28, cache_dir=None, max_disk_bytes=2 ** 30):
+        """
+        Params:
+        * max_bytes:      maximum total size of the tables kept in memory,
+        * cache_dir:      directory of the on-disk store (disabled if None),
+        * max_disk_bytes: maximum total size of the tables kept on disk.
+        """
+        self.max_bytes      = max_bytes
+        self.cache_dir      = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.tables         = OrderedDict() # key -> table, ordered from least to most recently used
+        self.n_bytes        = 0
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(P):
+        """Return the hash of the preference matrix."""
+        P = np.ascontiguousarray(P, dtype=np.int64)
+        return hashlib.sha1(np.array(P.shape, dtype=np.int64).tobytes() + P.tobytes()).hexdigest()
+
+    def fetch(self, P, build, kind=None, persist=True):
+        """
+        Return the table of the preference matrix `P` from memory or disk if available, otherwise 
+        build it by calling `build()` and store it in the cache. `kind` tells apart the different 
+        tables of the same `P`, and only the tables to `persist` (arrays) are stored on disk.
+        """
+        key = self.key(P) if kind is None else "%s-%s" % (self.key(P), kind)
+        if key in self.tables:
+            self.hits += 1
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        table = self._load(key) if persist else None
+        if table is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            table = build()
+            if persist:
+                self._save(key, table)
+        self._put(key, table)
+        return table
+
+    @staticmethod
+    def _nbytes(table):
+        if isinstance(table, tuple):
+            return sum([ StructureCache._nbytes(t) for t in table ])
+        if sp.issparse(table):
+            return table.data.nbytes + table.indices.nbytes + table.indptr.nbytes
+        return table.nbytes
+
+    def _put(self, key, table):
+        self.tables[key] = table
+        self.n_bytes    += self._nbytes(table)
+        while self.n_bytes > self.max_bytes and len(self.tables) > 1:
+            _, evicted    = self.tables.popitem(last=False)
+            self.n_bytes -= self._nbytes(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, "%s.npy" % key)
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        # the table may be evicted by a concurrent run at any time, which is then a miss
+        try:
+            os.utime(self._path(key))              # mark as recently used
+            return np.load(self._path(key), mmap_mode="r")
+        except FileNotFoundError:
+            return None
+
+    def _save(self, key, table):
+        if self.cache_dir is None:
+            return
+        # write to a temporary file first so that concurrent runs never read a partial table
+        tmp_path = self._path(key) + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "wb") as f:
+            np.save(f, table)
+        os.replace(tmp_path, self._path(key))
+        # evict the least recently used tables on disk (skipping the ones removed by concurrent runs)
+        stats   = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(".npy"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, fname))
+            except FileNotFoundError:
+                continue
+            stats.append((stat.st_mtime, stat.st_size, os.path.join(self.cache_dir, fname)))
+        stats.sort()
+        n_bytes = sum([ size for _, size, _ in stats ])
+        while n_bytes > self.max_disk_bytes and len(stats) > 1:
+            _, size, path = stats.pop(0)
+            n_bytes      -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
 
 class HypercubeQ(object):
     """
@@ -12,13 +157,20 @@ class HypercubeQ(object):
     * 1. We consider eta_{ij} = 1, i.e., there is only one optimal unit for each dispatch.
     * 2. We consider t_{ij} = tau_{ij}, i.e., the unit is always in its home atom when it is available.
 
+    For zones that are too large to enumerate all 2^N states, the approximate hypercube procedure 
+    (`method="approx"`) iterates on the busy probabilities of individual units instead, which only 
+    takes polynomial time.
+
     Reference:
     * Richard C. Larson. A hypercube queuing model for facility location and redistricting in urban 
       emergency services. Computers & Operations Research, 1(1):67 – 95, 1974.
+    * Richard C. Larson. Approximating the performance of urban emergency service systems. 
+      Operations Research, 23(5):845 – 868, 1975.
     """
 
 
-    def __init__(self, n_atoms, Lam=None, T=None, P=None, cap="zero", max_iter=10, q_len=100):
+    def __init__(self, n_atoms, Lam=None, T=None, P=None, cap="zero", max_iter=None, q_len=100, q_tol=None,
+        solver="gauss-seidel", tol=1e-10, omega=1., method="exact", Disp=None, cache=None):
         """
         Params:
         * n_atoms:  number of geographical atoms (= number of response units),
@@ -26,12 +178,26 @@ class HypercubeQ(object):
         * T:        a matrix of average traffic time per dispatch (from atom i to atom j),
         * P:        a matrix of dispatch policy (the n-th unit at atom j),
         * cap:      `zero` or `inf`,
-        * max_iter: maximum number of iteration for obtaining the steady-state probabilities,
-        * q_len:    the reserved length of the queue.
+        * max_iter: maximum number of iteration for obtaining the steady-state probabilities 
+                    (10 sweeps for `jacobi` and 1000 sweeps for `gauss-seidel` by default),
+        * q_len:    the reserved length of the queue,
+        * q_tol:    if specified, the queue is truncated adaptively once the remaining tail probability 
+                    drops below `q_tol` (and `q_len` is only an upper bound),
+        * solver:   `jacobi` (fixed number of point Jacobi sweeps), `gauss-seidel` (SOR sweeps until 
+                    the residual drops below `tol`) or `direct` (sparse LU factorization),
+        * tol:      tolerance of the residual of the balance equations,
+        * omega:    relaxation factor of the `gauss-seidel` solver (1 is plain Gauss-Seidel),
+        * method:   `exact` (solve the full hypercube) or `approx` (Larson's approximate procedure, 
+                    where `Pi` are the probabilities of the number of busy units instead of states),
+        * Disp:     a precomputed matrix of optimal dispatched units of another model with the same `P` 
+                    (see `_upward_transition_rates`), which only depends on the dispatch policy,
+        * cache:    a `StructureCache` for looking up and storing `Disp` by the dispatch policy.
         """
         # Model configuration
         # - line capacity
         self.cap     = cap
+        # - exact or approximate hypercube
+        self.method  = method
         # - number of geographical atoms (response units)
         self.n_atoms = n_atoms                    
         # - arrival rates vector: arrival rates for each atom
@@ -45,29 +211,128 @@ class HypercubeQ(object):
                self.T.shape[1] == self.P.shape[0] == self.P.shape[1], \
                "Invalid shape of input parameters."
 
+        assert method in ["exact", "approx"], "Unknown method %s." % method
+        if cap == "inf" and not self.Lam.sum() < self.n_atoms:
+            raise ValueError("Infinite-line capacity requires the total arrival rate (%f) to be less than the number of units (%d)." % \
+                (self.Lam.sum(), self.n_atoms))
+
         # Model status
-        # - state space ordered as a sequence represents a complete unit-step tour of the hypercube
-        self.S                  = self._tour()
-        self.all_busy_state_idx = np.array([ self.S[i].sum() for i in range(2 ** self.n_atoms) ]).argmax()
-        self.all_zero_state_idx = 0
-        # - upward transition rates matrix: a dictionary { (i,j) : lam_ij } (due to the sparsity of the matrix in nature)
-        # print("[%s] calculating upward transition rates ..." % arrow.now(), file=sys.stderr)
-        self.Lam_ij = self._upward_transition_rates()
-        # - steady-state probability for unsaturate states
-        # print("[%s] calculating steady-state probabilities ..." % arrow.now(), file=sys.stderr)
-        self.Pi         = self._steady_state_probs(cap=self.cap, max_iter=max_iter)
+        # - steady-state probability for the number of busy units (an M/M/N queue)
+        with tracing.span("hypercubeq.busy_levels", n_atoms=self.n_atoms):
+            self.Pk = self._busy_level_probs(cap=self.cap)
+        if self.method == "exact":
+            # - state space ordered as a sequence represents a complete unit-step tour of the hypercube
+            # - each state is encoded as an integer bitmask (bit n is set iff unit n is busy), where
+            #   `codes[i]` is the bitmask of the i-th state in the tour and `pos[code]` is its tour position
+            with tracing.span("hypercubeq.tour", n_states=2 ** self.n_atoms):
+                self.codes = self._tour()
+            self.all_busy_state_idx = int(self.pos[2 ** self.n_atoms - 1])
+            self.all_zero_state_idx = int(self.pos[0])
+            # - upward transition rates: atom k moves state s to s | 1 << Disp[k,s] with rate lam_k, 
+            #   where Disp is an int8 matrix of the optimal dispatched units indexed by state codes (N 2^N bytes)
+            with tracing.span("hypercubeq.upward_transition_rates", n_states=2 ** self.n_atoms) as span:
+                if Disp is None and cache is not None:
+                    misses  = cache.misses
+                    Disp    = cache.fetch(self.P, self._upward_transition_rates)
+                    span.set("cache_hit", int(cache.misses == misses))
+                self.Disp   = self._upward_transition_rates() if Disp is None else Disp
+                # the upward transition rates as a sparse matrix, whose structure is shared by the
+                # models with the same `P` (see `_upward_matrix`)
+                G, C        = self._upward_matrix() if cache is None else \
+                    cache.fetch(self.P, self._upward_matrix, kind="upward", persist=False)
+                self.Up     = sp.csr_matrix((C.dot(self.Lam), G.indices, G.indptr), shape=G.shape)
+                # upward transitions (one per atom of each non-saturated state) and downward 
+                # transitions (one per busy unit of each state)
+                span.set("n_transitions", self.n_atoms * (2 ** self.n_atoms - 1) + self.n_atoms * 2 ** (self.n_atoms - 1))
+            # - steady-state probability for unsaturate states
+            #   `residual` is the L1 norm of the balance equations and `n_iter` the number of sweeps
+            with tracing.span("hypercubeq.steady_state", n_states=2 ** self.n_atoms, solver=solver) as span:
+                self.Pi     = self._steady_state_probs(cap=self.cap, max_iter=max_iter, solver=solver, tol=tol, omega=omega)
+                span.set("n_iter", self.n_iter)
+                span.set("residual", float(self.residual))
+                span.set("converged", self.converged)
+            self._check_convergence(solver)
+        else:
+            # - steady-state probability for the number of busy units
+            self.all_busy_state_idx = self.n_atoms
+            self.all_zero_state_idx = 0
+            self.Pi     = self.Pk
         # - steady-state probability for saturate states (only for infinite-line capacity)
-        self.Pi_Q       = np.array([ self._steady_state_probs_in_queue(j) for j in range(1, q_len) ]) if self.cap == "inf" else []
-        # the probability that a randomly arriving call incurs a queue delay
-        self.Pi_Q_prime = self.Pi_Q.sum() + self.Pi[self.all_busy_state_idx] if self.cap == "inf" else 0
+        with tracing.span("hypercubeq.queue"):
+            self.Pi_Q       = self._steady_state_probs_in_queue(np.arange(1, self._queue_length(q_len, q_tol))) if self.cap == "inf" else []
+            # the probability that a randomly arriving call incurs a queue delay
+            self.Pi_Q_prime = self.Pi_Q.sum() + self.Pi[self.all_busy_state_idx] if self.cap == "inf" else 0
+        # - busy probability of each response unit (only for approximate hypercube)
+        #   `residual` is the largest change of the busy probabilities and `n_iter` the number of iterations
+        if self.method == "approx":
+            with tracing.span("hypercubeq.approx_busy_probs", n_atoms=self.n_atoms) as span:
+                self.Rho_u  = self._approx_busy_probs(cap=self.cap, max_iter=max_iter, tol=tol)
+                span.set("n_iter", self.n_iter)
+                span.set("converged", self.converged)
+            self._check_convergence("approx")
 
         # Model evaluation metrics
         # - fraction of dispatches that send a unit n to a particular geographical atom j
-        # print("[%s] calculating dispatch fraction ..." % arrow.now(), file=sys.stderr)
-        self.Rho_1, self.Rho_2 = self._dispatch_fraction(cap=self.cap)
+        with tracing.span("hypercubeq.dispatch_fraction"):
+            self.Rho_1, self.Rho_2 = self._dispatch_fraction(cap=self.cap)
         # - average travel time of each disptach for each response unit
-        # print("[%s] calculating average travel time ..." % arrow.now(), file=sys.stderr)
-        self.Tu = self._average_travel_time(cap=self.cap)
+        with tracing.span("hypercubeq.travel_time"):
+            self.Tu = self._average_travel_time(cap=self.cap)
+
+    @classmethod
+    def batch(cls, P, Lams, T=None, Ts=None, **kwargs):
+        """
+        Evaluate a stack of scenarios of the same zone, where the dispatch policy `P` (and thus the 
+        tour and the optimal dispatched units) is shared by all scenarios, and only the arrival 
+        rates (and optionally the traffic matrices) change, e.g., over years or hours of the day. 
+        The structural parts of the model are built once, and scenarios with identical arrival 
+        rates are only solved once.
+
+        Params:
+        * P:      a matrix of dispatch policy shared by all scenarios,
+        * Lams:   a matrix of arrival rates with one row per scenario (or a single vector),
+        * T:      a matrix of average traffic time shared by all scenarios, or
+        * Ts:     a stack of matrices of average traffic time with one matrix per scenario,
+        * kwargs: other configurations of the model (`cap`, `method`, `solver`, `q_len`, ...).
+        Return:
+        * a dictionary of stacked `Pi`, `Pi_Q`, `Rho_1`, `Rho_2`, `Rho` (= Rho_1 + Rho_2), `Tu`, 
+          `residual`, `n_iter` and `converged`, where the first axis is the scenario.
+        """
+        assert (T is None) != (Ts is None), "Either T or Ts should be specified."
+        P        = np.array(P, dtype=int)
+        Lams     = np.atleast_2d(np.array(Lams, dtype=float))
+        Ts       = np.array([T], dtype=float) if Ts is None else np.array(Ts, dtype=float)
+        n_scens  = max(len(Lams), len(Ts))
+        Lams     = np.broadcast_to(Lams, (n_scens, P.shape[0]))
+        Ts       = np.broadcast_to(Ts, (n_scens, P.shape[0], P.shape[0]))
+        # solve each unique vector of arrival rates, sharing the structural tables through a cache
+        uniq_Lams, inverse = np.unique(Lams, axis=0, return_inverse=True)
+        if kwargs.get("cache") is None:
+            kwargs["cache"] = StructureCache()
+        models   = []
+        Disp     = None
+        for Lam in uniq_Lams:
+            hq   = cls(P.shape[0], Lam=Lam, T=Ts[0], P=P, Disp=Disp, **kwargs)
+            Disp = getattr(hq, "Disp", None)
+            models.append(hq)
+        # collect the results of each scenario
+        results  = { key: [] for key in ["Pi", "Pi_Q", "Rho_1", "Rho_2", "Rho", "Tu", "residual", "n_iter", "converged"] }
+        for b in range(n_scens):
+            hq   = models[np.ravel(inverse)[b]]
+            hq.T = Ts[b]
+            Tu   = hq._average_travel_time(cap=hq.cap)
+            for key, val in zip(results.keys(), [ hq.Pi, hq.Pi_Q, hq.Rho_1, hq.Rho_2, hq.Rho_1 + hq.Rho_2, 
+                Tu, hq.residual, hq.n_iter, hq.converged ]):
+                results[key].append(val)
+        return { key: np.array(vals) for key, vals in results.items() }
+
+    @property
+    def S(self):
+        """
+        Dense matrix of the states in the order of the tour, where S[i,n] = 1 iff the n-th unit is 
+        busy in the i-th state. It is only built on request since it takes O(N 2^N) memory.
+        """
+        return ((self.codes[:,None] >> np.arange(self.n_atoms, dtype=np.uint32)) & 1).astype(float)
 
     def _tour(self):
         """
@@ -77,140 +342,286 @@ class HypercubeQ(object):
         complete sequence S_1, S_2, ... of N-digit binary numbers, with 2^N unique members in the 
         sequence and with adjacent members being exactly unit-Hamming distance apart. Such a 
         sequence represents a complete unit-step tour of the hypercube.
+
+        The tour is the binary reflected Gray code, i.e., the i-th state is i XOR (i >> 1) where the 
+        n-th bit of the code indicates the status of the n-th response unit.
         """
-        # initialization
-        S      = np.zeros((2 ** self.n_atoms, self.n_atoms))
-        S[1,0] = 1    # S_0 = 0, S_1 = 1
-        m, i   = 2, 2 # m: number of states that needs step backwards; i: index of the state
-        # add "one" at i-th position and step backwards
-        for n in range(1, self.n_atoms):
-            S[i:i+m,n]  = 1                                 # add "one" at i-th position
-            S[i:i+m,:n] = np.flip(S[int(i-m):i,:n], axis=0) # step backwards
-            i          += m                                 # update index of the state
-            m          *= 2                                 # update the number of states that needs step backwards
-        return S
+        self.codes, self.pos, self.n_busy, self.n_trailing = state_tables(self.n_atoms)
+        return self.codes
 
     def _upward_transition_rates(self):
         """
         An efficient method for generating upward transition rates from state i to state j of the  
         hypercube queueing model.
 
-        For each geographical atom j we shall tour the hypercube in a unit-step fashion. 
+        For each geographical atom k, a call moves state s to its upward optimal neighbor by 
+        assigning the first idle unit in the k-th row of the preference matrix, i.e., the rate 
+        lam_k is added to the transition from s to s | 1 << Disp[k,s]. The optimal dispatched units 
+        are stored in an int8 matrix (the all busy state has no available unit and is marked as -1).
+
+        Let s' be the state code with its bits reordered by the preference of atom k, then the 
+        optimal unit is the one whose priority equals the number of trailing ones of s'. The 
+        reordered codes of all states are built by doubling, so each atom only takes O(2^N).
         """
-        Upoptn = self.__upward_optimal_neighbor() # upward optimal neighbor matrix
-        Lam_ij = defaultdict(lambda: 0)           # upward transition rates dictionary initialization
+        Disp  = np.empty((self.n_atoms, 2 ** self.n_atoms), dtype=np.int8)
+        for k in range(self.n_atoms):                     # for each atom k
+            prefs = np.append(self.P[k], -1).astype(np.int8)
+            rank  = np.argsort(self.P[k]).astype(np.uint32) # priority of each unit for atom k
+            perm  = np.zeros(1, dtype=np.uint32)
+            for n in range(self.n_atoms):
+                perm = np.concatenate([perm, perm | (np.uint32(1) << rank[n])])
+            Disp[k] = prefs[self.n_trailing[perm]]
+        return Disp
 
-        # iterative algorithm for generating upward transition rates
-        for k in range(self.n_atoms):          # for each atom k
-            for i in range(2 ** self.n_atoms): # for each state i
-                if self.S[i].sum() < self.n_atoms:
-                    Lam_ij[(i,Upoptn[k,i])] += self.Lam[k]
-        return Lam_ij
-    
-    def __upward_optimal_neighbor(self):
-        """
-        A function that collects the upward optimal neighbor given atom k at state i according 
-        to the dispatch policy.
-        """
-        # helper function that returns the state index given the state
-        def state_index(s):
-            for i in range(2 ** self.n_atoms):
-                if np.count_nonzero(s - self.S[i]) == 0:
-                    return i
-
-        # calculate upward optimal neighbors matrix
-        Upopts = np.zeros((self.n_atoms, 2 ** self.n_atoms), dtype=int)
-        for k in range(self.n_atoms):                # for each atom k
-            for i in range(2 ** self.n_atoms):       # for each state i (last state is excluded)
-                idle_u = np.where(self.S[i] == 0)[0] # indices of idle response units
-                if len(idle_u) != 0:
-                    disp_u = self.P[k]               # ordered indices of response units for atom k according to dispatch policy 
-                    for u in disp_u:                 # find out the first available idle unit to be assigned to atom k
-                        if u in idle_u:
-                            add         = np.zeros(self.n_atoms, dtype=int)
-                            add[u]      = 1
-                            upopts      = self.S[i] + add
-                            Upopts[k,i] = state_index(upopts)
-                            break
-                else:
-                    Upopts[k,i] = -1                 # for the all busy state, there is no upward neighbor
-        return Upopts
-
-    def _steady_state_probs(self, cap, max_iter):
-        """
-        A iterative procedure for obtaining the steady state probability on the hypercube. In a manner
-        similar to point Jacobi iteration, we use the equation of detailed balance to determine the 
-        values at successive iterations. 
+    def _upward_targets(self, k, states=None):
+        """
+        Return the upward optimal neighbors of the given states (all states except for the all busy 
+        state by default) for the calls from atom k, indexed by state codes.
+        """
+        if states is None:
+            states = np.arange(2 ** self.n_atoms - 1, dtype=np.uint32)
+        bits = np.uint32(1) << np.arange(self.n_atoms, dtype=np.uint32)
+        return states | bits[self.Disp[k,states]]
+
+    def _upward_matrix(self):
+        """
+        Return the structure of the upward transitions, which only depends on the dispatch policy, 
+        i.e., the (2^N x 2^N) CSR pattern G of the pairs (t, s) such that a call from some atom moves
+        state s to state t, and the (nnz(G) x N) sparse matrix C whose row of each pair indicates the
+        atoms whose calls make the transition, so that the upward transition rates of a model are
+        `C Lam` on the pattern of G. The pairs of the atoms dispatching the same unit are merged, so
+        G has at most N (2^N - 1) entries (O(N 2^N) memory, shared through the `StructureCache`).
+        """
+        n_states      = 2 ** self.n_atoms
+        targets       = np.concatenate([ self._upward_targets(k) for k in range(self.n_atoms) ]).astype(np.int64)
+        sources       = np.tile(np.arange(n_states - 1, dtype=np.int64), self.n_atoms)
+        atoms         = np.repeat(np.arange(self.n_atoms), n_states - 1)
+        # the pairs sorted by (target, source), i.e., in the order of the entries of G
+        pairs, inverse = np.unique(targets * n_states + sources, return_inverse=True)
+        indptr        = np.concatenate([ [0], np.cumsum(np.bincount(pairs // n_states, minlength=n_states)) ])
+        G             = sp.csr_matrix((np.ones(len(pairs)), (pairs % n_states).astype(np.int32), indptr.astype(np.int32)), 
+            shape=(n_states, n_states))
+        C             = sp.csr_matrix((np.ones(len(atoms)), (np.ravel(inverse), atoms)), shape=(len(pairs), self.n_atoms))
+        return G, C
+
+    def _inflow(self, Pi):
+        """
+        Return the total inflow rate of each state given the probabilities `Pi` indexed by state 
+        codes. The upward inflows are a product with the sparse upward transition rates `Up` (see 
+        `_upward_matrix`), and the downward inflows of each unit n are strided views of the states 
+        with and without the n-th bit.
+        """
+        inflow   = self.Up.dot(Pi)
+        for n in range(self.n_atoms):
+            inflow.reshape(-1, 2, 2 ** n)[:,0,:] += Pi.reshape(-1, 2, 2 ** n)[:,1,:]
+        return inflow
+
+    def _outflow_rates(self):
+        """
+        Return the total outflow rate of each state indexed by state codes, i.e., the total arrival 
+        rate (except for the all busy state) plus the number of busy units.
+        """
+        out      = self.n_busy.astype(float) + self.Lam.sum()
+        out[-1] -= self.Lam.sum()
+        return out
+
+    def _generator(self):
+        """
+        Return the transposed transition rate matrix of the hypercube (with zero-line capacity) as 
+        a sparse matrix A, where A[j,i] is the transition rate from state i to state j and the 
+        diagonal is the negative total outflow rate of each state. States are indexed by their 
+        bitmask codes, so that upward transitions are below the diagonal and downward transitions 
+        are above the diagonal. Each state has at most N upward and N downward neighbors.
+
+        For infinite-line capacity, the transitions between the all busy state and the queue 
+        states are in detailed balance, so the hypercube states share the same balance equations.
+        """
+        n_states = 2 ** self.n_atoms
+        states   = np.arange(n_states - 1, dtype=np.uint32) # all states except for the all busy state
+        codes    = np.arange(n_states, dtype=np.uint32)
+        # upward transitions: atom k calls its optimal idle unit with rate lam_k
+        up_from  = np.tile(states, self.n_atoms)
+        up_to    = np.concatenate([ self._upward_targets(k) for k in range(self.n_atoms) ])
+        up_rate  = np.repeat(self.Lam, len(states))
+        # downward transitions: each busy unit completes its service with rate 1
+        dn_from  = np.concatenate([ codes[codes & (1 << n) != 0] for n in range(self.n_atoms) ])
+        dn_to    = np.concatenate([ codes[codes & (1 << n) != 0] ^ np.uint32(1 << n) for n in range(self.n_atoms) ])
+        A = sp.coo_matrix((
+            np.concatenate([up_rate, np.ones(len(dn_from)), -self._outflow_rates()]),
+            (np.concatenate([up_to, dn_to, codes]), np.concatenate([up_from, dn_from, codes]))),
+            shape=(n_states, n_states))
+        return A.tocsr()
+
+    def _steady_state_probs(self, cap, max_iter, solver="gauss-seidel", tol=1e-10, omega=1.):
+        """
+        A procedure for obtaining the steady state probability on the hypercube by solving the 
+        equations of detailed balance A pi = 0, where A is the transition rate matrix. Three solvers 
+        are available:
+        * `jacobi`:       in a manner similar to point Jacobi iteration, use the equation of detailed 
+                          balance to determine the values at successive iterations, where the all 
+                          idle and all busy states are fixed (the original fixed-sweep procedure);
+        * `gauss-seidel`: successive over-relaxation sweeps, which stop when the residual of the 
+                          balance equations is smaller than `tol`. Since each transition changes 
+                          the number of busy units by one, the states with an odd number of busy 
+                          units only depend on the states with an even number of busy units and vice 
+                          versa, so each sweep updates the two halves at once (red-black ordering);
+        * `direct`:       sparse LU factorization of the balance equations, where one of the 
+                          equations is replaced by the normalization condition (the fill-in grows 
+                          quickly with N, so it is only practical for small zones).
+        Except for the direct solver, the transition rate matrix is never built and the memory only 
+        scales with 2^N.
 
         For all idle state, all busy state, and S_Q (more than N customers in the system), the steady   
-        state probabilities can be calculated as a normal M/M/N queue with infinite-line capacity.
-        """
-        # steady state probabilities initialization
-        def init_steady_state_prob(cap):
-            Pi_0 = np.zeros(2 ** self.n_atoms)
-            for n_busy in range(self.n_atoms + 1):
-                denominator = sum([
-                    self.Lam.sum() ** j / math.factorial(j)
-                    for j in range(self.n_atoms + 1) ]) \
-                    if cap == "zero" else \
-                    sum([ 
-                        (self.Lam.sum() ** j / math.factorial(j)) 
-                        for j in range(self.n_atoms + 1) ]) + \
-                    (self.Lam.sum() ** self.n_atoms / math.factorial(self.n_atoms)) * \
-                    (self.Lam.sum() / self.n_atoms / (1 - self.Lam.sum() / self.n_atoms))
-                n_states    = sum([ 1 for i in range(2 ** self.n_atoms) if self.S[i].sum() == n_busy ])
-                init_P      = (self.Lam.sum() ** n_busy / math.factorial(n_busy)) / denominator / n_states
-                for i in range(2 ** self.n_atoms):
-                    if self.S[i].sum() == n_busy:
-                        Pi_0[i] = init_P
-            return Pi_0
-
-        # point Jacobi iteration for all states except for all idle state, all busy state
-        def iter_steady_state_prob(Pi_n):
-            # initialize the steady state probabilities Pi_{n+1} for the next iteration
-            Pi_n_1 = np.copy(Pi_n)
-            # update the steady state probability of each state i
-            for j in range(2 ** self.n_atoms):
-                # except for all idle state, all busy state
-                if self.S[j].sum() != 0 and self.S[j].sum() != self.n_atoms:
-                    upward_sum   = 0
-                    downward_sum = 0
-                    for i in range(2 ** self.n_atoms):
-                        # the k-th response unit that changed status (upward and downward in total)
-                        changed_k = np.nonzero(self.S[j] - self.S[i])[0]
-                        # only consider one-step changed states
-                        if len(changed_k) == 1:
-                            # upward transition state
-                            if (self.S[j] - self.S[i]).sum() == 1:
-                                upward_sum += Pi_n[i] * self.Lam_ij[(i,j)]
-                            # downward transition state
-                            elif (self.S[j] - self.S[i]).sum() == -1:
-                                downward_sum += Pi_n[i] * 1 # self.Mu[changed_k[0]]
-                    # update the j-th state in Pi_{n+1}
-                    Pi_n_1[j] = (upward_sum + downward_sum) / (self.Lam.sum() + self.S[j].sum())
-            return Pi_n_1
-        
-        # initialize all states
-        Pi = init_steady_state_prob(cap)
-        # update all states except for all idle state, all busy state
-        for n in range(max_iter):
-            Pi = iter_steady_state_prob(Pi)
-        return Pi
+        state probabilities can be calculated as a normal M/M/N queue with infinite-line capacity, 
+        which are used as the initial solution and to scale the hypercube probabilities.
+        """
+        assert solver in ["jacobi", "gauss-seidel", "direct"], "Unknown solver %s." % solver
+        if max_iter is None:
+            max_iter = 10 if solver == "jacobi" else 1000
+
+        out  = self._outflow_rates()
+        # initialize all states (indexed by state codes) by spreading the probability of each number 
+        # of busy units evenly over the C(N, k) states with k busy units
+        Pi_0 = (self.Pk / comb(self.n_atoms, np.arange(self.n_atoms + 1)))[self.n_busy]
+        mass = self.Pk.sum()                     # total probability of the hypercube states
+        Pi   = np.copy(Pi_0)
+        self.n_iter    = 0
+        # the fixed-sweep and the direct solvers have no stopping criterion
+        self.converged = solver != "gauss-seidel"
+
+        if solver == "jacobi":
+            # update all states except for all idle state, all busy state
+            inner = (self.n_busy != 0) & (self.n_busy != self.n_atoms)
+            for n in range(max_iter):
+                Pi_n_1        = self._inflow(Pi) / out
+                Pi[inner]     = Pi_n_1[inner]
+                self.n_iter  += 1
+        elif solver == "gauss-seidel":
+            # successive over-relaxation on the odd and even states in turn, where the residual of 
+            # each half is measured right before its update
+            odd    = self.n_busy % 2 == 1
+            for n in range(max_iter):
+                residual = 0.
+                for half in [ odd, ~odd ]:
+                    inflow    = self._inflow(np.where(half, 0., Pi))
+                    residual += np.abs(inflow - out * Pi)[half].sum()
+                    Pi        = np.where(half, omega * inflow / out + (1 - omega) * Pi, Pi)
+                Pi           *= mass / Pi.sum()
+                self.n_iter  += 1
+                if residual < tol:
+                    self.converged = True
+                    break
+        elif solver == "direct":
+            # replace the last balance equation by the normalization condition
+            A         = self._generator()
+            B         = sp.vstack([A[:-1,:], sp.csr_matrix(np.ones((1, 2 ** self.n_atoms)))]).tocsc()
+            b         = np.zeros(2 ** self.n_atoms)
+            b[-1]     = mass
+            with tracing.span("hypercubeq.lu", nnz=B.nnz):
+                Pi    = spsolve(B, b)
+            self.n_iter = 1
+
+        self.residual = np.abs(self._inflow(Pi) - out * Pi).sum()
+        # reorder the steady state probabilities by the tour
+        return Pi[self.codes]
     
+    def _check_convergence(self, solver):
+        """Warn if the iterative solver stopped at `max_iter` before the residual dropped below `tol`."""
+        if not self.converged:
+            warnings.warn("%s solver of the hypercube (N=%d) did not converge: residual %e after %d iterations" % \
+                (solver, self.n_atoms, self.residual, self.n_iter), RuntimeWarning, stacklevel=3)
+
+    def _busy_level_probs(self, cap):
+        """
+        Return the steady state probabilities of having exactly 0, 1, ..., N busy units, which are 
+        calculated as a normal M/M/N queue with zero-line or infinite-line capacity. The normalizing 
+        constant is computed once in log-space (`log_Z`) to avoid overflow at large arrival rates or 
+        number of units.
+        """
+        lam     = self.Lam.sum()
+        k       = np.arange(self.n_atoms + 1)
+        log_p   = k * np.log(lam) - gammaln(k + 1)
+        if cap == "zero":
+            self.log_Z = logsumexp(log_p)
+        else:
+            r          = lam / self.n_atoms
+            self.log_Z = logsumexp(np.append(log_p, log_p[-1] + np.log(r / (1 - r))))
+        return np.exp(log_p - self.log_Z)
+
+    def _approx_busy_probs(self, cap, max_iter=None, tol=1e-10):
+        """
+        Approximate Hypercube Procedure
+
+        Instead of solving the balance equations over all 2^N states, the busy probabilities rho_n 
+        of the individual units are determined by a fixed-point iteration. Given the aggregate 
+        probabilities P_k of k busy units, the probability that the first j preferred units of an 
+        atom are busy while the (j+1)-th is idle is approximated by Q(N, rho, j) prod_l rho_l (1 - rho), 
+        where the correction factor Q assumes that busy units are randomly located given their 
+        number. The workload of unit n, i.e., the arrival rate of the calls dispatched to it, then 
+        yields rho_n = V_n / (1 + V_n) (plus the calls served from the queue for infinite-line 
+        capacity), which is rescaled to match the utilization of the M/M/N queue.
+        """
+        if max_iter is None:
+            max_iter = 1000
+        N, lam   = self.n_atoms, self.Lam.sum()
+        # average utilization of the units and the call rate served from the queue per unit
+        Pk       = self.Pk
+        rho      = (np.arange(N + 1) * Pk).sum() / N + (1 - Pk.sum())
+        queue    = lam * self.Pi_Q_prime / N if cap == "inf" else 0.
+        # correction factors Q(N, rho, j) for j = 0, ..., N-1 in log-space
+        j, k     = np.meshgrid(np.arange(N), np.arange(N), indexing="ij")
+        valid    = k >= j
+        log_comb = lambda n, m: gammaln(n + 1) - gammaln(m + 1) - gammaln(n - m + 1)
+        log_q    = np.where(valid, 
+            np.log(Pk[:N])[None,:] + log_comb(N - j - 1, np.where(valid, k - j, 0)) - log_comb(N, k), -np.inf)
+        self.log_Q = logsumexp(log_q, axis=1) - np.arange(N) * np.log(rho) - np.log(1 - rho)
+
+        # fixed-point iteration on the busy probabilities of the units
+        Rho_u    = np.full(N, rho)
+        self.n_iter, self.residual = 0, np.inf
+        while self.n_iter < max_iter and self.residual >= tol:
+            rates          = self.Lam[:,None] * self.__approx_busy_ahead_probs(Rho_u)
+            V              = np.bincount(self.P.flatten(), weights=rates.flatten(), minlength=N)
+            Rho_u_new      = (V + queue) / (1 + V)
+            Rho_u_new     *= rho * N / Rho_u_new.sum()
+            self.residual  = np.abs(Rho_u_new - Rho_u).max()
+            self.n_iter   += 1
+            Rho_u          = Rho_u_new
+        self.converged = self.residual < tol
+        return Rho_u
+
+    def __approx_busy_ahead_probs(self, Rho_u):
+        """
+        Return a matrix whose entry (j, k) is the approximate probability that a call from atom j 
+        finds the first k preferred units busy, i.e., Q(N, rho, k) prod_{l<k} rho_{P[j,l]}.
+        """
+        log_rho  = np.log(Rho_u[self.P])
+        log_busy = np.cumsum(log_rho, axis=1) - log_rho # all the preferred units ahead are busy
+        return np.exp(self.log_Q[None,:] + log_busy)
+
     def _steady_state_probs_in_queue(self, n_waiting):
         """
-        Return the probability of exactly `n_waiting` calls in queue, assuming steady state 
-        conditions.
+        Return the probability of exactly `n_waiting` calls in queue (a scalar or an array), 
+        assuming steady state conditions, i.e., the geometric tail P_N r^n of the M/M/N queue.
+        """
+        n_waiting = np.asarray(n_waiting)
+        assert (n_waiting >= 1).all(), "n_waiting should larger than 1."
+        r         = self.Lam.sum() / self.n_atoms
+        return self.Pk[-1] * np.exp(n_waiting * np.log(r))
+
+    def _queue_length(self, q_len, q_tol=None):
+        """
+        Return the reserved length of the queue. If `q_tol` is specified, it is the smallest length 
+        (up to `q_len`) such that the probability of more waiting calls, P_N r^L / (1 - r), is 
+        below `q_tol`.
         """
-        assert n_waiting >= 1, "n_waiting should larger than 1."
-        denominator = sum([ 
-            (self.Lam.sum() ** j / math.factorial(j)) 
-            for j in range(self.n_atoms + 1) ]) + \
-            (self.Lam.sum() ** self.n_atoms / math.factorial(self.n_atoms)) * \
-            (self.Lam.sum() / self.n_atoms / (1 - self.Lam.sum() / self.n_atoms))
-        Pi_Q_j = (self.Lam.sum() ** self.n_atoms / math.factorial(self.n_atoms)) * \
-                 (self.Lam.sum() / self.n_atoms) ** n_waiting / denominator
-        return Pi_Q_j
+        if q_tol is None:
+            return q_len
+        r      = self.Lam.sum() / self.n_atoms
+        log_pn = np.log(self.Pk[-1]) - np.log(1 - r)
+        if log_pn < np.log(q_tol):
+            return 1
+        return int(min(q_len, np.ceil((np.log(q_tol) - log_pn) / np.log(r)) + 1))
 
     def _dispatch_fraction(self, cap):
         """
@@ -224,62 +635,42 @@ class HypercubeQ(object):
           queue delay.
           The final result is the sum of Rho_1 and Rho_2.
         """
-        # a helper function that returns the set of states in which unit n is an optimal unit to 
-        # assign to a call from atom j.
-        def states_optimal_dispatch(n, j):
-            states = []
-            for i in range(2 ** self.n_atoms):
-                disp_u = self.P[j]
-                idle_u = np.where(self.S[i] == 0)[0]
-                if n in idle_u:
-                    priority_u_n     = disp_u.tolist().index(n)                             # priority of unit n 
-                    priority_u_other = [ 
-                        disp_u.tolist().index(u) 
-                        for u in idle_u if u != n]                                          # priority of other units
-                    if len(priority_u_other) == 0 or priority_u_n <= min(priority_u_other): # if unit n has the highest priority
-                        states.append(i)
-            return states
-
-        # E_{nj} dictionary
-        E_nj = {}
-        for n in range(self.n_atoms):
-            for j in range(self.n_atoms):
-                E_nj[(n,j)] = states_optimal_dispatch(n, j)
-        E_nj[(n,j)] = states_optimal_dispatch(n, j)
-        # fraction of all dispatches that send unit n to atom j and incur no queue delay
-        Rho_1 = np.zeros((self.n_atoms, self.n_atoms), dtype=float)
-        # fraction of all dispatches that send unit n to atom j and do incur a positive queue delay
-        Rho_2 = np.zeros((self.n_atoms, self.n_atoms), dtype=float)
-        # calculate Rho_1 and Rho_2
-        for n in range(self.n_atoms):
-            for j in range(self.n_atoms):
-                if cap == "zero":
-                    denominator = self.Lam.sum() * (1 - self.Pi[self.all_busy_state_idx])
-                    numerator   = sum([ self.Lam[j] * self.Pi[i] 
-                        for i in E_nj[(n, j)] ])
-                    Rho_1[n,j]  = numerator / denominator
-                else:
-                    Rho_2[n,j]  = self.Lam[j] / self.Lam.sum() * self.Pi_Q_prime / self.n_atoms
-                    Rho_1[n,j]  = sum([ self.Lam[j] / self.Lam.sum() * self.Pi[i] 
-                        for i in E_nj[(n, j)] ])
+        # W[j,n] is the probability of the set of states E_{nj} in which unit n is an optimal unit 
+        # to assign to a call from atom j
+        if self.method == "exact":
+            Pi_c  = self.Pi[self.pos]         # indexed by state codes
+            W     = np.stack([ 
+                np.bincount(self.Disp[j,:-1], weights=Pi_c[:-1], minlength=self.n_atoms) 
+                for j in range(self.n_atoms) ])
+        else:
+            # the preferred units ahead are busy and unit n is idle
+            W     = np.zeros((self.n_atoms, self.n_atoms))
+            probs = self.__approx_busy_ahead_probs(self.Rho_u) * (1 - self.Rho_u[self.P])
+            np.put_along_axis(W, self.P, probs, axis=1)
+        # Rho_1: fraction of all dispatches that send unit n to atom j and incur no queue delay
+        # Rho_2: fraction of all dispatches that send unit n to atom j and do incur a positive queue delay
+        if cap == "zero":
+            denominator = self.Lam.sum() * (1 - self.Pi[self.all_busy_state_idx])
+            Rho_1       = (self.Lam[:,None] * W).T / denominator
+            Rho_2       = np.zeros((self.n_atoms, self.n_atoms), dtype=float)
+        else:
+            Rho_1       = (self.Lam[:,None] * W).T / self.Lam.sum()
+            Rho_2       = np.tile(self.Lam / self.Lam.sum() * self.Pi_Q_prime / self.n_atoms, (self.n_atoms, 1))
         return  Rho_1, Rho_2
 
     def _average_travel_time(self, cap):
         """
         Return the average travel time of each dispatch for each response unit.
         """
-        Tu  = np.zeros(self.n_atoms)
         f   = self.Lam / self.Lam.sum()
         T_Q = np.matmul(f, np.matmul(self.T, f))
-        for n in range(self.n_atoms):
-            if cap == "zero":
-                numerator   = (self.T[n,:] * self.Rho_1[n,:]).sum() 
-                denominator = self.Rho_1[n,:].sum()
-                Tu[n]       = numerator / denominator
-            else:
-                numerator   = (self.T[n,:] * self.Rho_1[n,:]).sum() + T_Q * self.Pi_Q_prime / self.n_atoms
-                denominator = self.Rho_1[n,:].sum() + self.Pi_Q_prime / self.n_atoms
-                Tu[n]       = numerator / denominator
+        if cap == "zero":
+            numerator   = (self.T * self.Rho_1).sum(axis=1)
+            denominator = self.Rho_1.sum(axis=1)
+        else:
+            numerator   = (self.T * self.Rho_1).sum(axis=1) + T_Q * self.Pi_Q_prime / self.n_atoms
+            denominator = self.Rho_1.sum(axis=1) + self.Pi_Q_prime / self.n_atoms
+        Tu  = numerator / denominator
         return Tu
 
 if __name__ == "__main__":
@@ -288,9 +679,10 @@ if __name__ == "__main__":
     # RANDOM INITIALIZED MODEL WITH ZERO-LINE CAPACITY
     # - model initialization
     start_t = arrow.now()
-    hq      = HypercubeQ(n_atoms=10, cap="zero", max_iter=10)
+    hq      = HypercubeQ(n_atoms=10, cap="zero")
     end_t   = arrow.now()
     print("Calculation time: [%s]" % (end_t - start_t))
+    print("Residual: %e (%d iterations)" % (hq.residual, hq.n_iter))
     # - steady-state probability
     print(hq.Pi)
     print(hq.Pi.sum())
@@ -304,7 +696,7 @@ if __name__ == "__main__":
 
     # RANDOM INITIALIZED MODEL WITH INFINITE-LINE CAPACITY
     # - model initialization
-    hq = HypercubeQ(n_atoms=10, cap="inf", max_iter=10)
+    hq = HypercubeQ(n_atoms=10, cap="inf")
     # - steady-state probability
     print(hq.Pi)    # steady-state probability for unsaturate states
     print(hq.Pi_Q)  # steady-state probability for saturate states (only for infinite-line capacity)
@@ -327,7 +719,7 @@ if __name__ == "__main__":
             [2, 0, 1]]
     T       = np.random.rand(n_atoms, n_atoms)
     # - model initialization
-    hq = HypercubeQ(n_atoms=3, Lam=Lam, P=P, T=T, cap="zero", max_iter=10)
+    hq = HypercubeQ(n_atoms=3, Lam=Lam, P=P, T=T, cap="zero")
     # - steady-state probability
     print(hq.Pi)
     print(hq.Pi.sum())
@@ -335,4 +727,20 @@ if __name__ == "__main__":
     print(hq.Rho_1)
     print(hq.Rho_1.sum())
     # - average travel time per dispatch for each unit
-    print(hq.Tu)
\ No newline at end of file
+    print(hq.Tu)
+
+
+
+    # APPROXIMATE MODEL WITH INFINITE-LINE CAPACITY FOR A CITY-WIDE DESIGN
+    # - model initialization
+    start_t = arrow.now()
+    hq      = HypercubeQ(n_atoms=78, cap="inf", method="approx")
+    end_t   = arrow.now()
+    print("Calculation time: [%s]" % (end_t - start_t))
+    print("Residual: %e (%d iterations)" % (hq.residual, hq.n_iter))
+    # - busy probability of each response unit
+    print(hq.Rho_u)
+    # - fraction of dispatches that send a unit n to a particular geographical atom j
+    print(hq.Rho_1.sum() + hq.Rho_2.sum())
+    # - average travel time per dispatch for each unit
+    print(hq.Tu)
@@ -0,0 +1,110 @@
+"""
+Shortest-path imputation of the missing travel times.
+
+The observed travel times between adjacent beats (in the beats graph) are the weights of the edges
+of a directed graph, and a missing travel time from one beat to another is imputed by the length
+of the shortest path between them, i.e., the time of the fastest chain of observed routes between
+adjacent beats. The all-pairs shortest paths are computed by Dijkstra on the sparse graph (in C),
+and kept up to date as new routes arrive, e.g.,
+
+    imputer = ShortestPathImputer(beats, graph_beats, adjacency).fit(Tau)
+    Tau     = imputer.transform()
+    imputer.update(i, j, tau_ij)                    # new mean travel time of the route (i, j)
+    Tau     = imputer.transform()
+
+The entries that no path reaches (e.g., the beats out of the beats graph, or the diagonal) are
+filled by the mean of the observed entries of their column, as `SimpleImputer(strategy="mean")`.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import dijkstra
+
+
+
+class ShortestPathImputer(object):
+    """
+    Imputer of Travel Times by All-pairs Shortest Paths
+
+    The travel times are missing where they are zero (as `SimpleImputer(missing_values=0.)`). The
+    edge of an adjacent pair is weighted by its observed travel time, or by the one of the reverse
+    route if only the latter is observed.
+    """
+
+    def __init__(self, beats, graph_beats, adjacency):
+        """
+        Params:
+        * beats:       list of beats in the order of the rows and columns of the travel times,
+        * graph_beats: list of beats in the order of the rows and columns of the adjacency,
+        * adjacency:   (sparse) adjacency matrix of the beats graph.
+        """
+        self.beats    = list(beats)
+        n             = len(self.beats)
+        graph_idx     = { beat: i for i, beat in enumerate(graph_beats) }
+        # map the adjacency onto the beats of the travel times (beats out of the graph have no edge)
+        mapped        = np.array([ graph_idx.get(beat, -1) for beat in self.beats ], dtype=np.int64)
+        adjacency     = sp.coo_matrix(adjacency)
+        to_beat       = np.full(len(graph_beats), -1, dtype=np.int64)
+        to_beat[mapped[mapped >= 0]] = np.where(mapped >= 0)[0]
+        rows, cols    = to_beat[adjacency.row], to_beat[adjacency.col]
+        valid         = (rows >= 0) & (cols >= 0) & (rows != cols) & (adjacency.data != 0)
+        self.adjacent = sp.csr_matrix((np.ones(valid.sum(), dtype=bool), (rows[valid], cols[valid])), shape=(n, n))
+        self.Tau, self.W, self.D = None, None, None
+
+    def _edge_weights(self):
+        """Return the (sparse) weights of the edges given the observed travel times."""
+        adj        = self.adjacent.tocoo()
+        weight     = self.Tau[adj.row, adj.col]
+        reverse    = self.Tau[adj.col, adj.row]
+        weight     = np.where(weight > 0, weight, reverse)
+        observed   = weight > 0
+        return sp.csr_matrix((weight[observed], (adj.row[observed], adj.col[observed])), shape=self.Tau.shape)
+
+    def fit(self, Tau):
+        """Compute the shortest paths between all the beats given the (n x n) observed travel times."""
+        self.Tau = np.array(Tau, dtype=np.float64)
+        self.W   = self._edge_weights()
+        self.D   = dijkstra(self.W, directed=True)
+        return self
+
+    def update(self, i, j, tau):
+        """
+        Set the observed travel time of the route from beat index `i` to `j` to `tau`, and update
+        the shortest paths. A faster edge relaxes all the paths through it in O(n^2), i.e.,
+        D = min(D, D[:, i] + w + D[j, :]), while a slower edge only reruns Dijkstra from the sources
+        whose shortest paths went through it.
+        """
+        self.Tau[i, j] = tau
+        if not self.adjacent[i, j] and not self.adjacent[j, i]:
+            return
+        old_W  = self.W
+        self.W = self._edge_weights()
+        D      = self.D
+        for a, b in [ (i, j), (j, i) ]:
+            old, new = old_W[a, b], self.W[a, b]
+            if old == new or not self.adjacent[a, b]:
+                continue
+            if old == 0 or (new != 0 and new < old):
+                # a new or faster edge
+                np.minimum(D, D[:, [a]] + new + D[[b], :], out=D)
+            else:
+                # a removed or slower edge, which invalidates the paths through it
+                sources = np.where((D[:, [a]] + old + D[[b], :] <= D + 1e-9 * np.abs(D)).any(axis=1))[0]
+                if len(sources) > 0:
+                    D[sources] = dijkstra(self.W, directed=True, indices=sources)
+
+    def transform(self):
+        """Return the travel times where the missing ones are imputed."""
+        Tau     = self.Tau.copy()
+        missing = Tau == 0
+        reached = missing & np.isfinite(self.D)
+        np.fill_diagonal(reached, False)
+        Tau[reached] = self.D[reached]
+        # fall back to the mean of the observed entries of each column
+        observed = ~missing
+        n_obs    = observed.sum(axis=0)
+        means    = np.divide(np.where(observed, self.Tau, 0.).sum(axis=0), n_obs,
+            out=np.zeros(Tau.shape[1]), where=n_obs > 0)
+        rest     = missing & ~reached
+        Tau[rest] = np.broadcast_to(means, Tau.shape)[rest]
+        return Tau
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+
+class IncrementalVariance(object):
+    """
+    Sample Variance of Zone Workloads under Zone Updates
+
+    The variance (as `statistics.variance`, i.e., with n - 1 degrees of freedom) is kept through the
+    running sum and sum of squares of the workloads, so that the variance after updating a few zones
+    (e.g., the two zones of a beat move) is scored in O(1) and then committed or rolled back. The
+    workloads are shifted by their initial mean to avoid the cancellation of the sum of squares,
+    and the sums are recomputed from scratch every `refresh_every` commits to bound the drift.
+    """
+
+    def __init__(self, values, refresh_every=1000):
+        """
+        Params:
+        * values:        initial workload of each zone,
+        * refresh_every: number of commits between two exact recomputations of the sums.
+        """
+        self.values        = np.array(values, dtype=np.float64)
+        self.n             = len(self.values)
+        self.shift         = self.values.mean()
+        self.refresh_every = refresh_every
+        self.n_commits     = 0
+        self.pending       = None # (updates, sum, sum of squares) of the proposed updates
+        assert self.n >= 2, "variance requires at least two zones"
+        self.refresh()
+
+    def refresh(self):
+        """Recompute the running sums from the workloads."""
+        shifted     = self.values - self.shift
+        self._sum   = shifted.sum()
+        self._sumsq = (shifted ** 2).sum()
+
+    def _variance(self, s, ss):
+        return max(ss - s * s / self.n, 0.) / (self.n - 1)
+
+    @property
+    def variance(self):
+        return self._variance(self._sum, self._sumsq)
+
+    def propose(self, updates):
+        """Return the variance after setting the workloads of the zones in `updates` (dict of index -> workload)."""
+        s, ss = self._sum, self._sumsq
+        for z, value in updates.items():
+            old, new = self.values[z] - self.shift, value - self.shift
+            s       += new - old
+            ss      += new * new - old * old
+        self.pending = (updates, s, ss)
+        return self._variance(s, ss)
+
+    def commit(self):
+        """Apply the proposed updates."""
+        updates, self._sum, self._sumsq = self.pending
+        for z, value in updates.items():
+            self.values[z] = value
+        self.pending    = None
+        self.n_commits += 1
+        if self.n_commits % self.refresh_every == 0:
+            self.refresh()
+
+    def rollback(self):
+        """Discard the proposed updates."""
+        self.pending = None
@@ -0,0 +1,227 @@
+"""
+Online linear surrogate of the design objective.
+
+The surrogate regresses the objective of a design (the variance of its zone workloads) on the
+beat-to-zone indicators of the design, as the OLS model fitted after the fact in `main_4`, but it
+is updated as each label arrives so that it can rank the candidates that are not evaluated yet and
+send only the most promising (or the most uncertain) ones to the hypercube queueing model.
+
+The design matrices of the surrogates are built as scipy.sparse matrices, since each design (or 
+decision) only sets one entry per beat, and fitted with a sparse least squares solver.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.stats import t as student_t
+from scipy.sparse.linalg import lsqr
+
+
+
+class FeatureBuilder(object):
+    """
+    Builder of Sparse Design Matrices
+
+    The column of each beat is looked up in a precomputed index map, and the beats out of the 
+    first `n_cols` columns (e.g., zone 7) are dropped.
+    """
+
+    def __init__(self, beats, n_cols=None):
+        """
+        Params:
+        * beats:  list of beats in the order of the columns,
+        * n_cols: number of columns (all the beats if None).
+        """
+        self.beats    = list(beats)
+        self.n_cols   = len(self.beats) if n_cols is None else n_cols
+        self.beat_idx = { beat: i for i, beat in enumerate(self.beats[:self.n_cols]) }
+
+    def _columns(self, beats):
+        cols = [ self.beat_idx.get(beat, -1) for beat in beats ]
+        return np.array(cols, dtype=np.int64)
+
+    def indicators(self, designs, n_zones=6, fixed_zones=("7",)):
+        """
+        Return the (n_designs x (n_cols * n_zones)) matrix of the indicators of the beats (rows of
+        the flattened (n_cols x n_zones) indicator matrix) in the zones of each design, where the
+        zone indices (positions in the design, including the `fixed_zones`) have to be < `n_zones`.
+        """
+        rows, cols = [], []
+        for i, design in enumerate(designs):
+            for z, zone in enumerate(design):
+                if zone in fixed_zones:
+                    continue
+                if z >= n_zones:
+                    raise ValueError("zone %s of design %d has index %d, which is out of the %d zones of the indicators" % 
+                        (zone, i, z, n_zones))
+                beat_cols = self._columns(design[zone])
+                beat_cols = beat_cols[beat_cols >= 0]
+                cols.append(beat_cols * n_zones + z)
+                rows.append(np.full(len(beat_cols), i, dtype=np.int64))
+        rows, cols = np.concatenate(rows + [ np.zeros(0, dtype=np.int64) ]), np.concatenate(cols + [ np.zeros(0, dtype=np.int64) ])
+        X          = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(designs), self.n_cols * n_zones))
+        X.sum_duplicates()
+        X.data[:]  = 1.
+        return X
+
+    def indicator_names(self, zones):
+        """Return the names `beat/zone` of the columns of `indicators` given the zone of each index."""
+        return [ "%s/%s" % (beat, zone) for beat in self.beats[:self.n_cols] for zone in zones ]
+
+    def weighted(self, beat_lists, weights):
+        """
+        Return the (n_rows x n_cols) matrix where row `i` has the weight `weights[i][k]` in the
+        column of the beat `beat_lists[i][k]`.
+        """
+        rows, cols, data = [], [], []
+        for i, (beats, w) in enumerate(zip(beat_lists, weights)):
+            beat_cols = self._columns(beats)
+            valid     = beat_cols >= 0
+            cols.append(beat_cols[valid])
+            data.append(np.asarray(w, dtype=np.float64)[valid])
+            rows.append(np.full(valid.sum(), i, dtype=np.int64))
+        empty = [ np.zeros(0, dtype=np.int64) ]
+        return sp.csr_matrix((np.concatenate(data + [ np.zeros(0) ]), (np.concatenate(rows + empty), np.concatenate(cols + empty))), 
+            shape=(len(beat_lists), self.n_cols))
+
+
+
+def minmax_scale(X):
+    """
+    Return the matrix scaled by its minimum and maximum over all entries, i.e., (X - min) / (max -
+    min), and the minimum and maximum. A sparse matrix stays sparse if its minimum is zero (which 
+    is the case if it has any implicit zero), otherwise it is made dense.
+    """
+    if sp.issparse(X):
+        X      = sp.csr_matrix(X)
+        # the implicit zeros count as entries
+        values = X.data if X.nnz == X.shape[0] * X.shape[1] else np.append(X.data, 0.)
+        lo, hi = values.min(), values.max()
+        if lo == 0.:
+            return X / (hi - lo), lo, hi
+        X      = X.toarray()
+    lo, hi = X.min(), X.max()
+    return (X - lo) / (hi - lo), lo, hi
+
+def add_constant(X):
+    """Append a column of ones to the (sparse) design matrix."""
+    if sp.issparse(X):
+        return sp.hstack([ X, np.ones((X.shape[0], 1)) ], format="csr")
+    return np.hstack([ X, np.ones((X.shape[0], 1)) ])
+
+def fit_sparse(X, y, tol=1e-10, inference=False):
+    """
+    Least squares fit of `y` on the (sparse) design matrix `X` by LSQR, which returns the minimum
+    norm solution as the pseudo-inverse used by `sm.OLS`. Return the weights and a summary. If 
+    `inference`, the summary also includes the standard errors `bse`, the `tvalues` and the 
+    two-sided `pvalues` of the weights as `sm.OLS`, i.e., from the covariance sigma^2 (X'X)^+ of 
+    the (p x p) normal equations, where sigma^2 is the residual variance on n - rank(X'X) degrees 
+    of freedom.
+    """
+    W, istop, n_iter = lsqr(X, y, atol=tol, btol=tol, iter_lim=10 * X.shape[1])[:3]
+    residual = y - X.dot(W)
+    summary  = {
+        "n_obs":     X.shape[0], "n_features": X.shape[1], "nnz": X.nnz if sp.issparse(X) else np.count_nonzero(X),
+        "n_iter":    n_iter, "mse": float(residual.dot(residual) / len(y)), 
+        "mse_total": float(((y - y.mean()) ** 2).sum() / (len(y) - 1)),
+        "r2":        float(1. - residual.dot(residual) / ((y - y.mean()) ** 2).sum()) }
+    if inference:
+        XtX      = X.T.dot(X)
+        XtX      = XtX.toarray() if sp.issparse(XtX) else XtX
+        df_resid = X.shape[0] - np.linalg.matrix_rank(XtX)
+        sigma2   = residual.dot(residual) / df_resid
+        bse      = np.sqrt(np.maximum(np.diag(np.linalg.pinv(XtX)), 0.) * sigma2)
+        # the weights of the empty (e.g., dropped) columns have no standard error, i.e., nan t-values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tvalues = W / bse
+        summary.update({ "params": W, "bse": bse, "tvalues": tvalues, "df_resid": int(df_resid),
+            "pvalues": 2 * student_t.sf(np.abs(tvalues), df_resid) })
+    return W, summary
+
+def summary_table(summary, names):
+    """
+    Return the table of the weights, standard errors, t-values and p-values of the features `names` 
+    (as the one of `sm.OLS`) given the summary of `fit_sparse(..., inference=True)`.
+    """
+    lines = [ "observations: %d, features: %d, df residuals: %d, R-squared: %.4f, MSE: %f" % \
+        (summary["n_obs"], summary["n_features"], summary["df_resid"], summary["r2"], summary["mse"]) ]
+    lines.append("%-8s %12s %12s %10s %8s" % ("", "coef", "std err", "t", "P>|t|"))
+    for name, coef, bse, tvalue, pvalue in zip(names, 
+        summary["params"], summary["bse"], summary["tvalues"], summary["pvalues"]):
+        lines.append("%-8s %12.4f %12.4f %10.3f %8.3f" % (name, coef, bse, tvalue, pvalue))
+    lines.append("total MSE: %f" % summary["mse_total"])
+    return "\n".join(lines)
+
+
+
+class OnlineSurrogate(object):
+    """
+    Online Ridge Regression with Predictive Uncertainty
+
+    The sufficient statistics (X'X, X'y, y'y) are accumulated as labels arrive, so that a refit
+    only solves a (p x p) system regardless of the number of labels. The standard deviation of a
+    prediction is the one of the Gaussian posterior of the weights, i.e., sigma * sqrt(x' A^-1 x)
+    with A = X'X + alpha I and sigma estimated from the residuals.
+    """
+
+    def __init__(self, n_features, alpha=1e-3):
+        """
+        Params:
+        * n_features: number of features (an intercept is added),
+        * alpha:      ridge penalty, which keeps the fit well-posed with fewer labels than features.
+        """
+        self.n_features = n_features + 1
+        self.alpha      = alpha
+        self.XtX        = np.zeros((self.n_features, self.n_features))
+        self.Xty        = np.zeros(self.n_features)
+        self.yty        = 0.
+        self.n          = 0
+        self.W, self.A_inv, self.sigma2 = None, None, None
+
+    @staticmethod
+    def _design(X):
+        if not sp.issparse(X):
+            X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        return add_constant(X)
+
+    def add(self, X, y):
+        """Add the labels `y` of the designs with features `X`."""
+        X, y      = self._design(X), np.atleast_1d(np.asarray(y, dtype=np.float64))
+        XtX       = X.T.dot(X)
+        self.XtX += XtX.toarray() if sp.issparse(XtX) else XtX
+        self.Xty += X.T.dot(y)
+        self.yty += y.dot(y)
+        self.n   += len(y)
+
+    def fit(self):
+        """Refit the weights from the accumulated statistics."""
+        A           = self.XtX + self.alpha * np.eye(self.n_features)
+        self.A_inv  = np.linalg.inv(A)
+        self.W      = self.A_inv.dot(self.Xty)
+        rss         = self.yty - 2 * self.W.dot(self.Xty) + self.W.dot(self.XtX).dot(self.W)
+        self.sigma2 = max(rss, 0.) / max(self.n - 1, 1)
+        return self
+
+    def predict(self, X, return_std=False):
+        """Return the predicted objectives (and their standard deviations) of the designs."""
+        X    = self._design(X)
+        mean = X.dot(self.W)
+        if not return_std:
+            return mean
+        XA   = X.dot(self.A_inv)
+        quad = np.asarray(X.multiply(XA).sum(axis=1)).ravel() if sp.issparse(X) else (XA * X).sum(axis=1)
+        return mean, np.sqrt(self.sigma2 * np.maximum(quad, 0.))
+
+
+
+def select(mean, std, k, strategy="top-k"):
+    """
+    Return the indices of `k` candidates, i.e., the ones with the lowest predicted objective
+    (`top-k`), or the ones with the most uncertain prediction (`uncertain`).
+    """
+    assert strategy in ["top-k", "uncertain"], "Unsupported strategy %s." % strategy
+    score = mean if strategy == "top-k" else -std
+    k     = min(k, len(score))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    idx   = np.argpartition(score, k - 1)[:k]
+    return idx[np.argsort(score[idx], kind="stable")]
@@ -0,0 +1,172 @@
+"""
+Opt-in tracing of the simulation pipeline.
+
+Named spans record the wall time of the hot paths (data preparation, each phase of `HypercubeQ`,
+each design evaluation) along with counters (e.g., number of states, nonzeros, cache hits), e.g.,
+
+    with tracing.span("hypercubeq.steady_state", n_states=2 ** n_atoms) as s:
+        ...
+        s.count("n_iter", n_iter)
+
+Tracing is disabled by default, in which case `span` returns a shared no-op span without reading
+the clock. It is enabled by `tracing.enable()` or by setting the environment variable `SIM_TRACE`
+to the path of the trace file, which is then written at exit. The trace is exported in the Chrome
+trace event format (viewable in chrome://tracing or Perfetto) along with a summary of each span.
+
+Worker processes of a `multiprocessing.Pool` exit without running `atexit`, so a pool initializer
+calls `enable_worker(path)` (with the `path()` of the parent) to write the spans of the worker to
+`<path>.<pid>` when the pool is closed and joined.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import multiprocessing
+import multiprocessing.util
+from collections import defaultdict
+
+
+
+class Span(object):
+    """A timed span with counters."""
+
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name  = name
+        self.args  = args
+        self.start = None
+
+    def count(self, key, value=1):
+        """Add `value` to the counter `key` of the span."""
+        self.args[key] = self.args.get(key, 0) + value
+
+    def set(self, key, value):
+        """Set the counter (or attribute) `key` of the span."""
+        self.args[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _tracer.record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+
+class NullSpan(object):
+    """A span that does nothing, returned when tracing is disabled."""
+
+    __slots__ = ()
+
+    def count(self, key, value=1):
+        pass
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = NullSpan()
+
+
+
+class Tracer(object):
+    """Collector of the finished spans of the current process."""
+
+    def __init__(self):
+        self.enabled = False
+        self.path    = None
+        self.origin  = time.perf_counter()
+        self.events  = []
+
+    def record(self, name, start, end, args):
+        self.events.append({
+            "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+            "ts":   (start - self.origin) * 1e6, "dur": (end - start) * 1e6, "args": args })
+
+    def summary(self):
+        """
+        Return the number of calls, the total and maximum wall time (seconds) and the summed numeric
+        counters of each span name.
+        """
+        summary = defaultdict(lambda: { "calls": 0, "total_time": 0., "max_time": 0., "counters": defaultdict(float) })
+        for event in self.events:
+            s                = summary[event["name"]]
+            s["calls"]      += 1
+            s["total_time"] += event["dur"] / 1e6
+            s["max_time"]    = max(s["max_time"], event["dur"] / 1e6)
+            for key, value in event["args"].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    s["counters"][key] += value
+        return { name: dict(s, counters=dict(s["counters"])) for name, s in summary.items() }
+
+_tracer = Tracer()
+
+
+
+def enable(path=None):
+    """Enable tracing (and write the trace to `path` at exit if specified)."""
+    _tracer.enabled = True
+    if path is not None:
+        _tracer.path = path
+        atexit.register(save, path)
+
+def enable_worker(path):
+    """
+    Enable tracing in a worker process of a pool (if `path` is not None), where the spans recorded
+    by the worker (without the ones inherited from the parent) are written to `<path>.<pid>` when 
+    the worker exits after the pool is closed (but not if the pool is terminated).
+    """
+    if path is None:
+        return
+    _tracer.enabled = True
+    _tracer.path    = "%s.%d" % (path, os.getpid())
+    reset()
+    multiprocessing.util.Finalize(None, save, args=(_tracer.path,), exitpriority=10)
+
+def path():
+    """Return the path of the trace file (None if tracing is disabled or not written)."""
+    return _tracer.path if _tracer.enabled else None
+
+def disable():
+    _tracer.enabled = False
+
+def is_enabled():
+    return _tracer.enabled
+
+def reset():
+    """Discard the recorded spans."""
+    _tracer.events = []
+    _tracer.origin = time.perf_counter()
+
+def span(name, **args):
+    """Return a span named `name` with the initial counters `args` (a no-op span if disabled)."""
+    if not _tracer.enabled:
+        return _null_span
+    return Span(name, args)
+
+def events():
+    return list(_tracer.events)
+
+def summary():
+    return _tracer.summary()
+
+def save(path):
+    """Write the recorded spans as a Chrome trace (with the summary) to `path`."""
+    with open(path, "w") as f:
+        json.dump({ "traceEvents": _tracer.events, "displayTimeUnit": "ms", "summary": summary() }, f, default=str)
+    print("trace of %d spans written to %s" % (len(_tracer.events), path), file=sys.stderr)
+
+
+
+if os.environ.get("SIM_TRACE"):
+    enable(os.environ["SIM_TRACE"])
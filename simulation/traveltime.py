@@ -1,130 +1,229 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from itertools import islice
+from scipy.spatial.distance import cdist
 from collections import defaultdict
 from sklearn.impute import SimpleImputer
 from matplotlib.backends.backend_pdf import PdfPages
 
+# mean radius of the Earth in metres
+EARTH_RADIUS         = 6371008.8
+# source files of the travel time estimations
+patrol_route_path    = "../data/traffic_time/patrol.route.txt"
+beats_centroids_path = "../data/beats_centroids.csv"
+
+def aggregate_routes(path=patrol_route_path, chunk_size=2 ** 18):
+    """
+    Aggregate the patrol routes (start beat, end beat, travel time) read in chunks of `chunk_size` 
+    lines into the total travel time and the number of samples per route. Beats are mapped to
+    indices once (in the order of their first appearance), and the totals of each chunk are 
+    accumulated by `bincount` on the flattened (start, end) indices, so that the memory in use is 
+    bounded by the size of a chunk and the number of beats regardless of the number of routes.
+    Return the sorted beats and the two (n_beats x n_beats) matrices.
+    """
+    beats, beat_ids = [], {}
+    capacity        = 0                            # number of beats the totals can hold
+    total_t         = np.zeros(0)
+    total_n         = np.zeros(0)
+
+    def index(names):
+        names, inverse = np.unique(names, return_inverse=True)
+        for name in names:
+            if name not in beat_ids:
+                beat_ids[name] = len(beats)
+                beats.append(name)
+        return np.array([ beat_ids[name] for name in names ], dtype=np.int64)[inverse]
+
+    with open(path, "r") as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if len(lines) == 0:
+                break
+            names     = np.loadtxt(lines, delimiter="\t", comments=None, usecols=(0, 1), dtype=str, ndmin=2)
+            dt        = np.loadtxt(lines, delimiter="\t", comments=None, usecols=(2,), ndmin=1)
+            start_idx = index(np.char.lstrip(names[:, 0]))
+            end_idx   = index(names[:, 1])
+            # grow the totals (doubling their capacity) if new beats appear
+            if len(beats) > capacity:
+                new_capacity = max(len(beats), 2 * capacity)
+                grown_t, grown_n = np.zeros((new_capacity, new_capacity)), np.zeros((new_capacity, new_capacity))
+                grown_t[:capacity, :capacity] = total_t.reshape(capacity, capacity)
+                grown_n[:capacity, :capacity] = total_n.reshape(capacity, capacity)
+                capacity, total_t, total_n    = new_capacity, grown_t.ravel(), grown_n.ravel()
+            pair_idx  = start_idx * capacity + end_idx
+            total_t  += np.bincount(pair_idx, weights=dt, minlength=capacity * capacity)
+            total_n  += np.bincount(pair_idx, minlength=capacity * capacity)
+
+    # reorder the beats (and the totals) alphabetically
+    order   = np.argsort(beats, kind="stable")
+    beats   = [ beats[i] for i in order ]
+    total_t = total_t.reshape(capacity, capacity)[np.ix_(order, order)]
+    total_n = total_n.reshape(capacity, capacity)[np.ix_(order, order)]
+    return beats, total_t, total_n
+
 def travel_time_from_patrol():
     """
     Get travel time estimation from the police patrolling records which includes
     the travel time information for each individual patrol routes associated with
     the officer id.
     """
-    # extract route data from file
-    routes = []
-    beats  = set()
-    with open("../data/traffic_time/patrol.route.txt", "r") as f:
-        for line in f.readlines():
-            data = line.strip().split("\t")
-            start_beat, end_beat, dt = data[0], data[1], float(data[2])
-            routes.append([start_beat, end_beat, dt])
-            beats = beats | set({start_beat, end_beat})
-
-    # get beats list
-    beats   = list(beats)
-    beats.sort()
-    n_beats = len(beats) 
-
-    # calculate total travel time per route (start beat, end beat, travel time)
-    total_t = np.zeros((n_beats, n_beats)) # total travel time per route
-    total_n = np.zeros((n_beats, n_beats)) # total number of samples per route 
-    for route in routes:
-        start_idx = beats.index(route[0])
-        end_idx   = beats.index(route[1])
-        dt        = route[2]
-        total_t[start_idx][end_idx] += dt
-        total_n[start_idx][end_idx] += 1
+    # calculate total travel time and total number of samples per route (start beat, end beat)
+    beats, total_t, total_n = aggregate_routes(patrol_route_path)
 
     # check if missing routes were inter-zones
     # - missing routes:   925   interzone   37  intrazone
     # - zero time routes: 1898  interzone   45  intrazone
     n_missing_routes   = len(np.where(total_n == 0)[0])
     n_zero_routes      = len(np.where(total_t == 0)[0])
-    n_interzone_routes = 0
-    n_intrazone_routes = 0
+    zones              = np.array([ beat[0] for beat in beats ])
     start_ids, end_ids = np.where(total_t == 0)
-    start_zones        = [ beats[start_id][0] for start_id in start_ids.tolist() ]
-    end_zones          = [ beats[end_id][0] for end_id in end_ids.tolist() ]  
-    for start_zone, end_zone in zip(start_zones, end_zones):
-        if start_zone == end_zone:
-            n_intrazone_routes += 1
-        else:
-            n_interzone_routes += 1
+    n_intrazone_routes = int((zones[start_ids] == zones[end_ids]).sum())
+    n_interzone_routes = len(start_ids) - n_intrazone_routes
     # print(n_interzone_routes, n_intrazone_routes, n_missing_routes, n_zero_routes)
 
     # travel time estimation (missing samples are set to be zero)
     Tau = np.divide(total_t, total_n, out=np.zeros_like(total_t), where=total_n!=0)
-    # np.save("data/p_tau", Tau)
     return beats, Tau
 
-def travel_time_from_distance():
+def pairwise_distance(coords, other=None, metric="manhattan", dtype=np.float64, block_size=None):
+    """
+    Pairwise distance matrix between two sets of points (or within a set if `other` is None).
+
+    Params:
+    * coords:     (n x 2) matrix of the [lat, lng] of the points in degrees,
+    * other:      (m x 2) matrix of the [lat, lng] of the other points in degrees,
+    * metric:     `manhattan` (in degrees, as the Hamming distance of the coordinates), 
+                  `manhattan-m` (in metres on the equirectangular projection at the mean latitude),
+                  or `haversine` (great-circle distance in metres),
+    * dtype:      dtype of the output, e.g., `np.float32` to halve the memory of large matrices,
+    * block_size: if specified, the distances are computed in blocks of `block_size` rows, so that
+                  the temporary memory is bounded by the size of a block.
+    Return:
+    * (n x m) matrix of distances.
+    """
+    assert metric in ["manhattan", "manhattan-m", "haversine"], "Unknown metric %s." % metric
+    coords = np.asarray(coords, dtype=np.float64)
+    other  = coords if other is None else np.asarray(other, dtype=np.float64)
+    if metric == "manhattan-m":
+        # project both sets on the same plane
+        lat0   = np.radians(np.concatenate([ coords[:, 0], other[:, 0] ]).mean())
+        coords = np.radians(coords) * EARTH_RADIUS * np.array([ 1., np.cos(lat0) ])
+        other  = np.radians(other) * EARTH_RADIUS * np.array([ 1., np.cos(lat0) ])
+
+    def block_distance(a, b):
+        if metric == "haversine":
+            a, b = np.radians(a)[:, None, :], np.radians(b)[None, :, :]
+            h    = np.sin((b[..., 0] - a[..., 0]) / 2) ** 2 + \
+                np.cos(a[..., 0]) * np.cos(b[..., 0]) * np.sin((b[..., 1] - a[..., 1]) / 2) ** 2
+            return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0., 1.)))
+        return cdist(a, b, metric="cityblock")
+
+    if block_size is not None and block_size < 1:
+        raise ValueError("block_size should be a positive number of rows, got %s" % block_size)
+    block_size = max(len(coords), 1) if block_size is None else block_size
+    Dist       = np.empty((len(coords), len(other)), dtype=dtype)
+    for i in range(0, len(coords), block_size):
+        Dist[i:i+block_size] = block_distance(coords[i:i+block_size], other)
+    return Dist
+
+def travel_time_from_distance(metric="manhattan", dtype=np.float64, block_size=None):
     """
     Get travel time estimation based on the distances of the centroids of two beats.
+    (see `pairwise_distance` for the metrics and the options)
     """
     # extract centroids data from file
     beats_centroids = {}
-    with open("../data/beats_centroids.csv", "r") as f:
+    with open(beats_centroids_path, "r") as f:
         for line in f.readlines():
             beat, lng, lat = line.strip().split(",")
             beats_centroids[beat] = [float(lat), float(lng)]
 
-    # helper function for Hamming distance
-    def hamming(a, b):
-        return abs(a[0] - b[0]) + abs(a[1] - b[1])
-
     # calculate the pairwise distance between beats
     beats   = list(beats_centroids.keys())
     beats.sort()
-    n_beats = len(beats)
-    Tau     = np.zeros((n_beats, n_beats))
-    for from_beat in beats:
-        for to_beat in beats:
-            from_beat_idx = beats.index(from_beat)
-            to_beat_idx   = beats.index(to_beat)
-            Tau[from_beat_idx][to_beat_idx] = hamming(beats_centroids[from_beat], beats_centroids[to_beat])
-    # np.save("data/d_tau", Tau)
+    coords  = np.array([ beats_centroids[beat] for beat in beats ]).reshape(-1, 2)
+    Tau     = pairwise_distance(coords, metric=metric, dtype=dtype, block_size=block_size)
     return beats, Tau
 
-def travel_time_vs_hamming_distance(p_beats, p_tau, d_beats, d_tau):
+def pair_join(p_beats, p_tau, d_beats, d_tau):
+    """
+    Join the travel times and the distances of the pairs of beats found in both matrices, where the
+    travel time is observed (positive). The beats are matched by index maps, and the pairs selected
+    by boolean masks over the joined submatrices, so that no pair is looked up one by one. Return
+    the distances, the travel times and the (start, end) indices (in `d_beats`) of the pairs, in the
+    row-major order of `d_beats`.
+    """
+    p_idx  = { beat: i for i, beat in enumerate(p_beats) }
+    d_idx  = np.array([ i for i, beat in enumerate(d_beats) if beat in p_idx ], dtype=np.int64)
+    p_sel  = np.array([ p_idx[d_beats[i]] for i in d_idx ], dtype=np.int64)
+    tau    = np.asarray(p_tau)[np.ix_(p_sel, p_sel)]
+    dist   = np.asarray(d_tau)[np.ix_(d_idx, d_idx)]
+    mask   = tau > 0
+    starts, ends = np.nonzero(mask)
+    return dist[mask], tau[mask], d_idx[starts], d_idx[ends]
+
+def binned_quantiles(X, Y, n_bins=50, quantiles=(.1, .5, .9)):
+    """
+    Return the centers of `n_bins` equal-width bins of `X` and the `quantiles` of `Y` in each bin
+    (nan for empty bins), computed by a single sort of the points by (bin, Y).
+    """
+    edges   = np.linspace(X.min(), X.max(), n_bins + 1)
+    bins    = np.clip(np.searchsorted(edges, X, side="right") - 1, 0, n_bins - 1)
+    order   = np.lexsort((Y, bins))
+    counts  = np.bincount(bins, minlength=n_bins)
+    offsets = np.concatenate([ [0], np.cumsum(counts)[:-1] ])
+    values  = np.full((len(quantiles), n_bins), np.nan)
+    filled  = counts > 0
+    for k, q in enumerate(quantiles):
+        # nearest-rank quantile within each bin
+        rank              = offsets + np.round(q * (counts - 1)).astype(np.int64)
+        values[k][filled] = Y[order[rank[filled]]]
+    return (edges[:-1] + edges[1:]) / 2, values
+
+def travel_time_vs_hamming_distance(p_beats, p_tau, d_beats, d_tau, mode="scatter", 
+    path="result/dist_vs_tau.pdf", n_bins=50, quantiles=(.1, .5, .9)):
     """
     plot the hamming distance between two beats vs its corresponding avg travel time.
+
+    Params:
+    * mode:      `scatter` (every pair as a point) or `hexbin` (the density of the pairs in hexagonal
+                 bins along with the binned quantiles of the travel time, which stays fast and small
+                 for millions of points),
+    * path:      path of the output pdf,
+    * n_bins:    number of distance bins of the quantile lines,
+    * quantiles: quantiles of the travel time plotted in each distance bin.
     """
+    assert mode in ["scatter", "hexbin"], "Unsupported mode %s." % mode
     # p_beats, p_tau = travel_time_from_patrol()
     # d_beats, d_tau = travel_time_from_distance()
     # construct x: distance of centroids, y: travel time
-    X, Y, pairs = [], [], []
-    for start_beat in d_beats:
-        for end_beat in d_beats:
-            if start_beat in p_beats and end_beat in p_beats:
-                p_start_beat_idx, p_end_beat_idx = p_beats.index(start_beat), p_beats.index(end_beat)
-                d_start_beat_idx, d_end_beat_idx = d_beats.index(start_beat), d_beats.index(end_beat)
-                if p_tau[p_start_beat_idx][p_end_beat_idx] > 0:
-                    x, y = d_tau[d_start_beat_idx][d_end_beat_idx], p_tau[p_start_beat_idx][p_end_beat_idx]
-                    X.append(x)
-                    Y.append(y)
-                    pairs.append([start_beat, end_beat])
+    X, Y, starts, ends = pair_join(p_beats, p_tau, d_beats, d_tau)
+    p_idx = { beat: i for i, beat in enumerate(p_beats) }
+    d_idx = { beat: i for i, beat in enumerate(d_beats) }
 
     def annotate_point(ax, start_beat, end_beat, c="r", upsidedown=-1):
-        d_start_beat_idx = d_beats.index(start_beat)
-        d_end_beat_idx   = d_beats.index(end_beat)
-        p_start_beat_idx = p_beats.index(start_beat)
-        p_end_beat_idx   = p_beats.index(end_beat)
+        x, y = d_tau[d_idx[start_beat]][d_idx[end_beat]], p_tau[p_idx[start_beat]][p_idx[end_beat]]
         print(start_beat, end_beat)
-        ax.scatter(
-            d_tau[d_start_beat_idx][d_end_beat_idx], 
-            p_tau[p_start_beat_idx][p_end_beat_idx], s=15, c=c)
+        ax.scatter(x, y, s=15, c=c)
         ax.annotate("from beat %s to beat %s" % (start_beat, end_beat),
-            xy=(d_tau[d_start_beat_idx][d_end_beat_idx], 
-                p_tau[p_start_beat_idx][p_end_beat_idx]), 
+            xy=(x, y), 
             xycoords='data',
             xytext=(-120, -1*upsidedown*80), textcoords='offset points',
             arrowprops=dict(arrowstyle="->",
                             connectionstyle="angle3,angleA=0,angleB=90"))
 
     # plot all points
-    with PdfPages("result/dist_vs_tau.pdf") as pdf:
+    with PdfPages(path) as pdf:
         fig, ax = plt.subplots(figsize=(10,10))
-        ax.scatter(X, Y, s=1)
+        if mode == "scatter":
+            ax.scatter(X, Y, s=1)
+        else:
+            hb = ax.hexbin(X, Y, gridsize=n_bins, bins="log", mincnt=1, cmap="Blues")
+            fig.colorbar(hb, ax=ax, label="number of pairs")
+            centers, values = binned_quantiles(X, Y, n_bins=n_bins, quantiles=quantiles)
+            for q, value in zip(quantiles, values):
+                ax.plot(centers, value, linewidth=1, label="%d%% quantile" % (q * 100))
+            ax.legend()
         ax.set_xlabel("Manhattan distance between beats")
         ax.set_ylabel("Average travel time (s)")
 
@@ -133,10 +232,10 @@ def travel_time_vs_hamming_distance(p_beats, p_tau, d_beats, d_tau):
         annotate_point(ax, start_beat="211", end_beat="111", c="red")
 
         # plot extreme points
-        max_t_pair = pairs[np.array(Y).argsort()[-1]]
-        max_d_pair = pairs[np.array(X).argsort()[-1]]
-        annotate_point(ax, start_beat=max_t_pair[0], end_beat=max_t_pair[1], c="red", upsidedown=1)
-        annotate_point(ax, start_beat=max_d_pair[1], end_beat=max_d_pair[0], c="red")
+        max_t = Y.argsort()[-1]
+        max_d = X.argsort()[-1]
+        annotate_point(ax, start_beat=d_beats[starts[max_t]], end_beat=d_beats[ends[max_t]], c="red", upsidedown=1)
+        annotate_point(ax, start_beat=d_beats[ends[max_d]], end_beat=d_beats[starts[max_d]], c="red")
 
         pdf.savefig(fig)
 
@@ -1,21 +1,45 @@
+import os
 import sys
 import arrow
-import copy
+import tracing
 import random
+import filecmp
+import argparse
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
-import statsmodels.api as sm
 import statistics as stats
-from itertools import combinations
+from itertools import combinations, islice
 from matplotlib.backends.backend_pdf import PdfPages
-from collections import defaultdict
-from hypercubeq import HypercubeQ
-from traveltime import travel_time_from_patrol, travel_time_from_distance
+from collections import defaultdict, OrderedDict
+from hypercubeq import HypercubeQ, StructureCache
+from datacache import DataCache, MatrixStore
+from beattable import BeatYearTable
+from designspace import DesignSpace, load_beats_graph
+from imputation import ShortestPathImputer
+from objective import IncrementalVariance
+from surrogate import OnlineSurrogate, FeatureBuilder, select, minmax_scale, fit_sparse, summary_table
+from checkpoint import ResultWriter, rng_state, set_rng_state, designs_hash, load_checkpoint, read_rows
+from traveltime import travel_time_from_patrol, travel_time_from_distance, patrol_route_path, beats_centroids_path
 from sklearn.impute import SimpleImputer
 from tqdm import tqdm
 
 # year configuration
 years = ["2013", "2014", "2015", "2016", "2017"]
+# source file of the 911 calls
+calls_path          = "../data/rawdata/911.calls.concise.txt"
+# adjacency of the beats
+beats_graph_path    = "../data/beats_graph.csv"
+# on-disk store of the parsed input data shared across runs
+data_cache_dir      = "../data/cache/preparation"
+# on-disk store of the travel time and distance matrices shared across runs
+matrix_store_dir    = "../data/cache/matrices"
+# on-disk store of the hypercube structures shared across runs
+structure_cache_dir = "../data/cache/hypercube"
+# in-memory budgets of the structure cache (in bytes) and the zone memo (in zones) of an evaluation,
+# which are split among the worker processes of a pool
+structure_cache_bytes = 2 ** 28
+zone_memo_entries     = 2 ** 16
 
 
 
@@ -27,39 +51,173 @@ def matrix_selection(mat, selected_beats, all_beats):
 
 
     
-def data_preparation():
-    """Data Preparation"""
-    # 1. get workload and count per beat (for building the arrival rates vectors `Lam`)
-    beat_info = defaultdict(lambda: defaultdict(lambda: {"workload": 0, "count": 0}))
-    n_calls, serv_t = 0, 0
-    with open("../data/rawdata/911.calls.concise.txt", "r", encoding='utf-8', errors='ignore') as f:
-        for line in f.readlines():
-            off_id, lat, lng, beat, call_t, disp_t, arv_t, clr_t = line.strip("\n").split("\t")
-            beat     = beat.strip()
-            n_calls += 1
-            serv_t  += float(clr_t) - float(arv_t)
-            workload = float(clr_t) - float(disp_t)
-            year     = str(arrow.get(clr_t).year)
-            if beat is not "" and workload > 0:
-                beat_info[beat][year]["workload"] += workload
-                beat_info[beat][year]["count"]    += 1
-    mu      = float(serv_t) / float(n_calls)                       # service rate Mu
-    w_beats = list(beat_info.keys())
+def read_call_chunks(path=calls_path, chunk_size=2 ** 18):
+    """
+    Read the 911 calls in chunks of `chunk_size` lines and yield the columns of each chunk, i.e., 
+    for each call, the name of its beat `beat` ("" if unknown), the `year` of its clearance (UTC), 
+    its `workload` (from dispatch to clearance) and its service time `serv_t` (from arrival to 
+    clearance). The memory in use is bounded by the size of a chunk regardless of the file size.
+    """
+    with open(path, "r", encoding='utf-8', errors='ignore') as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if len(lines) == 0:
+                return
+            # columns: off_id, lat, lng, beat, call_t, disp_t, arv_t, clr_t
+            beat   = np.loadtxt(lines, delimiter="\t", comments=None, usecols=(3,), dtype=str, ndmin=1)
+            disp_t, arv_t, clr_t = np.loadtxt(lines, delimiter="\t", comments=None, usecols=(5, 6, 7), ndmin=2).T
+            # year of the clearance time from the epoch seconds
+            year   = np.floor(clr_t).astype(np.int64).astype("datetime64[s]").astype("datetime64[Y]").astype(np.int64) + 1970
+            yield {
+                "beat":     np.char.strip(beat),
+                "year":     year.astype(np.int16),
+                "workload": clr_t - disp_t,
+                "serv_t":   clr_t - arv_t }
+
+def _index_beats(names, beat_ids, beats):
+    """
+    Return the indices of the beat names in `beats`, where the unseen names are appended to `beats` 
+    (and `beat_ids`, the index of each name) in the order of their first appearance.
+    """
+    names, first_idx, inverse = np.unique(names, return_index=True, return_inverse=True)
+    for k in np.argsort(first_idx):
+        if names[k] not in beat_ids:
+            beat_ids[names[k]] = len(beats)
+            beats.append(names[k])
+    return np.array([ beat_ids[name] for name in names ], dtype=np.int32)[inverse]
+
+def parse_calls(path=calls_path, chunk_size=2 ** 18):
+    """
+    Parse the 911 calls into columns, i.e., the beat names `beats` (in the order of their first
+    appearance), and for each call, the index of its beat `beat` (-1 if unknown), its `year`, 
+    its `workload` and its service time `serv_t`.
+    """
+    beats, beat_ids, columns = [], {}, defaultdict(list)
+    for chunk in read_call_chunks(path, chunk_size):
+        known       = chunk["beat"] != ""
+        beat        = np.full(len(known), -1, dtype=np.int32)
+        beat[known] = _index_beats(chunk["beat"][known], beat_ids, beats)
+        columns["beat"].append(beat)
+        for key in ["year", "workload", "serv_t"]:
+            columns[key].append(chunk[key])
+    return dict({ key: np.concatenate(values) for key, values in columns.items() }, 
+        beats=np.array(beats, dtype=str))
+
+def call_chunks(calls, chunk_size=2 ** 18):
+    """
+    Yield the parsed calls (see `parse_calls`, e.g., memory-mapped from the cache) in chunks of the 
+    same columns as `read_call_chunks`.
+    """
+    names = np.append(calls["beats"], "") # the unknown beat -1 is mapped to ""
+    for start in range(0, len(calls["beat"]), chunk_size):
+        chunk         = { key: np.asarray(calls[key][start:start + chunk_size]) for key in ["year", "workload", "serv_t"] }
+        chunk["beat"] = names[calls["beat"][start:start + chunk_size]]
+        yield chunk
+
+def beat_workload(chunks):
+    """
+    Aggregate the chunks of calls into the workload and count per beat per year (calls without beat 
+    or with non-positive workload are ignored), where the beats are in the order of their first 
+    appearance among the remaining calls, and the average service time `mu` over all calls. Only 
+    the totals per (beat, year) are kept across chunks.
+    """
+    beats, beat_ids = [], {}
+    keys, count, load = np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0) # totals per (beat, year)
+    n_calls, serv_t   = 0, 0.
+    for chunk in chunks:
+        n_calls += len(chunk["serv_t"])
+        serv_t  += chunk["serv_t"].sum()
+        valid    = (chunk["beat"] != "") & (chunk["workload"] > 0)
+        beat     = _index_beats(chunk["beat"][valid], beat_ids, beats)
+        # merge the totals of the chunk into the running totals
+        keys, inverse = np.unique(np.concatenate([ keys, beat.astype(np.int64) * 2 ** 16 + chunk["year"][valid] ]), 
+            return_inverse=True)
+        count = np.bincount(inverse, weights=np.concatenate([ count, np.ones(valid.sum()) ]))
+        load  = np.bincount(inverse, weights=np.concatenate([ load, chunk["workload"][valid] ]))
+    years, year_idx = np.unique(keys % 2 ** 16, return_inverse=True)
+    shape           = (len(beats), len(years))
+    counts, loads   = np.zeros(shape, dtype=np.int64), np.zeros(shape)
+    counts[keys // 2 ** 16, year_idx] = count
+    loads[keys // 2 ** 16, year_idx]  = load
+    return {
+        "beats":    np.array(beats, dtype=str),
+        "years":    years.astype(str),
+        "count":    counts,
+        "workload": loads,
+        "mu":       np.array(serv_t / n_calls) }
+
+def imputed_travel_time(imputation="mean"):
+    """
+    Travel time matrix between beats with missing entries completed by the mean of their column
+    (`mean`), or by the shortest paths of observed travel times between adjacent beats in the beats
+    graph (`shortest-path`, see `imputation.ShortestPathImputer`).
+    """
+    assert imputation in ["mean", "shortest-path"], "Unsupported imputation %s." % imputation
+    t_beats, Tau = travel_time_from_patrol()
+    if imputation == "mean":
+        imputer = SimpleImputer(missing_values=0., strategy='mean')
+        Tau     = imputer.fit_transform(Tau)
+    else:
+        graph_beats, adjacency = load_beats_graph(beats_graph_path)
+        Tau     = ShortestPathImputer(t_beats, graph_beats, adjacency).fit(Tau).transform()
+    return t_beats, Tau
+
+
+
+def data_preparation(cache_dir=data_cache_dir, matrix_dir=matrix_store_dir, metric="manhattan", imputation="mean"):
+    """
+    Data Preparation
+
+    The parsed calls and the derived data are kept in a binary cache in `cache_dir`, and the travel
+    time and distance matrices in a content-addressed store in `matrix_dir` (each disabled if None), 
+    which are rebuilt whenever the source files (or the parameters) change. `metric` is the metric
+    of the distance matrix (see `traveltime.pairwise_distance`) and `imputation` the imputation of
+    the missing travel times (see `imputed_travel_time`).
+    """
+    cache = DataCache(cache_dir) if cache_dir is not None else None
+    store = MatrixStore(matrix_dir) if matrix_dir is not None else None
+
+    def fetch_matrix(name, sources, params=None, *, build):
+        with tracing.span("data_preparation.%s" % name) as span:
+            if store is None:
+                return build()
+            hits   = store.hits
+            matrix = store.fetch(name, sources, params, build=build)
+            span.set("cache_hit", store.hits - hits)
+            return matrix
+
+    def fetch(name, sources, params=None, *, build):
+        with tracing.span("data_preparation.%s" % name) as span:
+            if cache is None:
+                return build()
+            hits   = cache.hits
+            arrays = cache.fetch(name, sources, params, build=build)
+            span.set("cache_hit", cache.hits - hits)
+            return arrays
+
+    # 1. get workload and count per beat (for building the arrival rates vectors `Lam`), which is
+    #    aggregated from the parsed calls (only parsed from the text file if they are not cached)
+    calls     = lambda: fetch("calls", [calls_path], build=lambda: parse_calls(calls_path))
+    workload  = fetch("beat_workload", [calls_path], build=lambda: beat_workload(call_chunks(calls())))
+    beat_info = BeatYearTable.from_arrays(workload)
+    mu      = float(workload["mu"])                                # service rate Mu
+    w_beats = beat_info.beats
     # print("[%s] workload for beats: %s" % (arrow.now(), w_beats), file=sys.stderr)
 
     # 2. get travel time (for building the traffic matrix `T`)
-    t_beats, Tau = travel_time_from_patrol()
-    # - complete the missing entries in tau matrix
-    imputer = SimpleImputer(missing_values=0., strategy='mean')
-    Tau     = imputer.fit_transform(Tau)                           # traffic matrix
+    #    (the missing entries in tau matrix are completed)
+    t_sources    = [ patrol_route_path ] + ([ beats_graph_path ] if imputation == "shortest-path" else [])
+    t_beats, Tau = fetch_matrix("tau", t_sources, { "imputation": imputation }, 
+        build=lambda: imputed_travel_time(imputation))                   # traffic matrix
     # print("[%s] travel time for beats: %s" % (arrow.now(), t_beats), file=sys.stderr)
 
     # 3. get beats pairwise distance (for building the preference matrix `P`)
-    d_beats, Dist = travel_time_from_distance()                    # preference matrix                                     
+    d_beats, Dist = fetch_matrix("dist", [beats_centroids_path], { "metric": metric }, 
+        build=lambda: travel_time_from_distance(metric=metric))         # preference matrix
     # print("[%s] beats distance for beats: %s" % (arrow.now(), d_beats), file=sys.stderr)
 
     # 4. get current design (`D`)
-    design  = defaultdict(lambda: [])                              # zone design
+    design  = defaultdict(list)                                    # zone design
     for beat in w_beats:
         design[beat[0]].append(beat)
     print("[%s] current design: %s" % (arrow.now(), design), file=sys.stderr)
@@ -106,48 +264,8 @@ def plot_barchart(x_name, x, y_name, title, data_1, data_2, path):
 
 
 
-def generate_design(old_design, min_rmv=2, n_rmv=5):
-    """Generate random design given the adjacency strucutre of beats and original design"""
-
-    with open("../data/beats_graph.csv") as f:
-        data      = list(f)
-        all_beats = [ beat.strip('"') for beat in data[0].strip("\n").split(",")[1:] ]
-        graph     = np.zeros((len(all_beats), len(all_beats)))
-        for i in range(1, len(data)):
-            graph[i-1, :] =  np.array([ int(d.strip('"')) for d in data[i].strip("\n").split(",")[1:] ])
-
-    def adjacent_designs(design):
-        adj_designs = []
-        for zone in design:
-            moved_beat = []
-            if zone == "7":
-                continue
-            for beat in design[zone]:
-                beat_id        = all_beats.index(beat)
-                neighbor_beats = [ all_beats[i] for i in np.where(graph[beat_id] == 1)[0] ]
-                # for each boundary beat
-                # if it is out of the zone, then put it into the zone
-                for nbeat in neighbor_beats:
-                    nzone = None
-                    for z in design:
-                        if nbeat in design[z]:
-                            nzone = z
-                            break
-                    if nzone != zone and nzone is not None and nbeat not in moved_beat:
-                        adj_design = copy.deepcopy(design)
-                        adj_design[zone].append(nbeat)
-                        adj_design[nzone].pop(adj_design[nzone].index(nbeat))
-                        # print("find a new adjacent design!")
-                        # print("move beat", nbeat)
-                        # print("from zone", nzone, adj_design[nzone])
-                        # print("to zone", zone, adj_design[zone])
-                        moved_beat.append(nbeat)
-                        # add an adjacent design
-                        adj_designs.append(adj_design)
-        return adj_designs
-        
-    # select a random subset of the old design as initial design
-    n = 5 # number of dropout
+def dropout_design(old_design, n=5):
+    """Select a random subset of the old design (in place) by dropping out `n` beats from each zone"""
     for zone in old_design:
         # get current beats set of the zone
         beats            = old_design[zone]
@@ -155,6 +273,19 @@ def generate_design(old_design, min_rmv=2, n_rmv=5):
         # drop out n beats from each zone
         beats            = beats[:len(beats)-n]
         old_design[zone] = beats
+    return old_design
+
+def generate_design(old_design, min_rmv=2, n_rmv=5):
+    """Generate random design given the adjacency strucutre of beats and original design"""
+
+    space = DesignSpace.from_graph(list(old_design.keys()), path=beats_graph_path)
+
+    def adjacent_designs(design):
+        # each adjacent design only copies the beat lists of the two zones of its move
+        return [ space.materialize(design, move) for move in space.moves(space.encode(design)) ]
+        
+    # select a random subset of the old design as initial design
+    dropout_design(old_design, n=5)
     
     # find the adjacent designs
     new_designs  = []
@@ -175,29 +306,32 @@ def main_1():
     """Evaluate the simulation model"""
 
     beat_info, mu, t_beats, Tau, d_beats, Dist, design = data_preparation()
+    cache = StructureCache(cache_dir=structure_cache_dir)
 
     print("finish data preprocessing")
 
     for zone in design.keys():
-        for year in years:
-            beats   = design[zone]
-            n_atoms = len(beats)
-            Eta     = np.array([ beat_info[beat][year]["count"] for beat in beats ])
-            Lam     = np.array([ beat_info[beat][year]["count"] for beat in beats ]) # TODO: Use lam estimation
-            Lam     = Lam / Lam.sum()
-            T       = matrix_selection(Tau, beats, t_beats)
-            P       = matrix_selection(Dist, beats, d_beats).argsort()
-            print("[%s] for zone %s, year %s" % (arrow.now(), zone, year), file=sys.stderr)
-            print("n_atoms", n_atoms, file=sys.stderr)
-            print("Lam", Lam, file=sys.stderr)
-            print("T", T, file=sys.stderr)
-            print("P", P, file=sys.stderr)
-            hq    = HypercubeQ(n_atoms, Lam=Lam, T=T, P=P, cap="inf", max_iter=10, q_len=100)
-            print("[%s] check hq model (%f)" % (arrow.now(), hq.Pi.sum() + hq.Pi_Q.sum()), file=sys.stderr)
-            avg_T = hq.Tu               
-            Frac  = hq.Rho_1 + hq.Rho_2
-            Y_hat = (Frac * Eta.sum() * (avg_T + mu)).sum()
-            Y     = sum([ beat_info[beat][year]["workload"] for beat in beats ])
+        # the zone structure is shared by all years, only the arrival rates change
+        beats   = design[zone]
+        n_atoms = len(beats)
+        Etas    = beat_info.count(beats, years).T
+        Lams    = Etas / Etas.sum(axis=1, keepdims=True) # TODO: Use lam estimation
+        T       = matrix_selection(Tau, beats, t_beats)
+        P       = matrix_selection(Dist, beats, d_beats).argsort()
+        print("[%s] for zone %s (%d beats)" % (arrow.now(), zone, n_atoms), file=sys.stderr)
+        with tracing.span("main_1.zone", zone=zone, n_atoms=n_atoms, n_years=len(years)):
+            try:
+                hqs = HypercubeQ.batch(P, Lams, T=T, cap="inf", q_len=100, cache=cache)
+            except ValueError as e:
+                print("[%s] skip infeasible zone %s: %s" % (arrow.now(), zone, e), file=sys.stderr)
+                continue
+        for i, year in enumerate(years):
+            print("[%s] check hq model for year %s (%f, residual %e after %d iterations)" % \
+                (arrow.now(), year, hqs["Pi"][i].sum() + hqs["Pi_Q"][i].sum(), hqs["residual"][i], hqs["n_iter"][i]), file=sys.stderr)
+            avg_T = hqs["Tu"][i]
+            Frac  = hqs["Rho"][i]
+            Y_hat = (Frac * Etas[i].sum() * (avg_T + mu)).sum()
+            Y     = beat_info.workload(beats, year).sum()
             print(Y_hat, Y, file=sys.stderr)
             print("%s\t%s\t%f\t%f" % (zone, year, Y, Y_hat))
 
@@ -224,14 +358,430 @@ def main_3():
 
         
 
-def main_4():
-    """Generate random valid design and get corresponding simulation output"""
+class ZoneMemo(object):
+    """
+    LRU Memo of Zone-level Simulation Results
+
+    Adjacent designs differ by a single beat move, so all but two of their zones are unchanged.
+    The memo keeps the simulated workload, the average travel time `Tu` and the fraction of 
+    dispatches `Rho` of each zone keyed by the set of its beats, the year and the service time `mu`. 
+    `Tu` and `Rho` are stored in the beat order of the first evaluation and permuted to the beat 
+    order of the caller on a hit (the values themselves do not depend on the beat order, see 
+    `zone_result`). The memo assumes that the rest of the data (`beat_info`, `Tau` and `Dist`) does 
+    not change, i.e., one memo is used for one output of `data_preparation`.
+    """
+
+    def __init__(self, max_entries=2 ** 16):
+        """
+        Params:
+        * max_entries: maximum number of zones kept in the memo.
+        """
+        self.max_entries  = max_entries
+        self.results      = OrderedDict() # key -> (beats, Y_hat, Tu, Rho), from least to most recently used
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(beats, year, mu):
+        """Return the key of the zone."""
+        return (frozenset(beats), year, mu)
+
+    def fetch(self, beats, year, mu, build):
+        """
+        Return the workload, `Tu` and `Rho` of the zone from the memo if available, otherwise compute
+        them by calling `build()` and store them in the memo.
+        """
+        key = self.key(beats, year, mu)
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            memo_beats, Y_hat, Tu, Rho = self.results[key]
+            if list(memo_beats) != list(beats):
+                Tu, Rho = permute_zone_result(memo_beats, beats, Tu, Rho)
+            return Y_hat, Tu, Rho
+        self.misses += 1
+        Y_hat, Tu, Rho    = build()
+        self.results[key] = (tuple(beats), Y_hat, Tu, Rho)
+        if len(self.results) > self.max_entries:
+            self.results.popitem(last=False)
+        return Y_hat, Tu, Rho
+
+
+
+def permute_zone_result(from_beats, to_beats, Tu, Rho):
+    """Permute `Tu` (per beat) and `Rho` (per pair of beats) from the order `from_beats` to `to_beats`"""
+    order = { beat: i for i, beat in enumerate(from_beats) }
+    idx   = [ order[beat] for beat in to_beats ]
+    return Tu[idx], Rho[np.ix_(idx, idx)]
+
+def zone_result(beats, year, beat_info, mu, t_beats, Tau, d_beats, Dist, cache=None):
+    """
+    Simulated workload, average travel time and fraction of dispatches of a zone in a year
+
+    The model is always built in the sorted order of the beats and `Tu` and `Rho` are permuted back 
+    to the order of `beats`, so that the result of a zone is bit-for-bit the same whatever the order
+    of its beats (e.g., in a memo shared by designs, or across the workers of a pool).
+
+    A zone whose queue is unstable (e.g., a single beat, since the arrival rates are normalized) is 
+    infeasible, and its workload is inf (and its `Tu` and `Rho` are nan) instead of aborting the run.
+    """
+    caller  = beats
+    beats   = sorted(beats)
+    n_atoms = len(beats)
+    Eta     = beat_info.count(beats, year)
+    Lam     = Eta / Eta.sum()
+    T       = matrix_selection(Tau, beats, t_beats)
+    P       = matrix_selection(Dist, beats, d_beats).argsort()
+    with tracing.span("zone_result", n_atoms=n_atoms) as span:
+        try:
+            hq  = HypercubeQ(n_atoms, Lam=Lam, T=T, P=P, cap="inf", q_len=100, cache=cache)
+        except ValueError as e:
+            span.set("infeasible", 1)
+            print("[%s] infeasible zone %s: %s" % (arrow.now(), beats, e), file=sys.stderr)
+            return np.inf, np.full(n_atoms, np.nan), np.full((n_atoms, n_atoms), np.nan)
+    avg_T   = hq.Tu               
+    Frac    = hq.Rho_1 + hq.Rho_2
+    Y_hat   = (Frac * Eta.sum() * (avg_T + mu)).sum()
+    return (Y_hat,) + permute_zone_result(beats, caller, avg_T, Frac)
+
+
+
+def zone_workload(beats, year, beat_info, mu, t_beats, Tau, d_beats, Dist, cache=None, memo=None):
+    """Simulated workload of a zone in a year given by the hypercube queueing model"""
+    build = lambda: zone_result(beats, year, beat_info, mu, t_beats, Tau, d_beats, Dist, cache)
+    if memo is None:
+        return build()[0]
+    with tracing.span("zone_workload") as span:
+        hits  = memo.hits
+        Y_hat = memo.fetch(beats, year, mu, build)[0]
+        span.set("memo_hit", memo.hits - hits)
+    return Y_hat
+
+
+
+def design_objective(Y):
+    """Variance of the zone workloads of a design (inf if any zone is infeasible)"""
+    return stats.variance(Y) if np.isfinite(Y).all() else np.inf
+
+
+
+def evaluate_design(design, year, beat_info, mu, t_beats, Tau, d_beats, Dist, cache=None, memo=None):
+    """Simulated workload of each zone (except for zone 7) of a design in a year"""
+    with tracing.span("evaluate_design", n_zones=len(design)):
+        return [ zone_workload(design[zone], year, beat_info, mu, t_beats, Tau, d_beats, Dist, cache, memo) 
+            for zone in design if zone != "7" ]
+
+
+
+# read-only data shared by the worker processes of the parallel design evaluation
+_worker_context = {}
+
+def _init_worker(context, trace_path=None, n_workers=1):
+    """Initialize a worker process with the read-only data and its own share of the cache and memo"""
+    tracing.enable_worker(trace_path)
+    _worker_context.update(context)
+    _worker_context["cache"] = StructureCache(max_bytes=structure_cache_bytes // n_workers, cache_dir=structure_cache_dir)
+    _worker_context["memo"]  = ZoneMemo(max_entries=zone_memo_entries // n_workers)
+
+def _evaluate_design_worker(design):
+    return evaluate_design(design, **_worker_context)
+
+
+
+class DesignEvaluator(object):
+    """
+    Long-lived Evaluator of Designs
+
+    The structure cache and the zone memo (or the pool of worker processes, each with its own cache
+    and memo) are created once and kept across calls of `evaluate`, so that successive batches of 
+    designs (e.g., the refit batches of the surrogate screening) share the zone results and only pay
+    the startup of the pool once. The workers split the memory budgets `structure_cache_bytes` and
+    `zone_memo_entries` evenly, so the total footprint does not grow with their number.
+    """
+
+    def __init__(self, context, n_workers=1, chunksize=1):
+        """
+        Params:
+        * context:   read-only data (`year`, `beat_info`, `mu`, `t_beats`, `Tau`, `d_beats`, and `Dist`),
+        * n_workers: number of worker processes (serial evaluation if 1),
+        * chunksize: number of designs per task of the pool.
+        """
+        self.context   = context
+        self.n_workers = n_workers
+        self.chunksize = chunksize
+        if n_workers <= 1:
+            self.cache = StructureCache(max_bytes=structure_cache_bytes, cache_dir=structure_cache_dir)
+            self.memo  = ZoneMemo(max_entries=zone_memo_entries)
+            self.pool  = None
+        else:
+            self.pool  = multiprocessing.Pool(n_workers, initializer=_init_worker, 
+                initargs=(context, tracing.path(), n_workers))
+
+    def evaluate(self, designs):
+        """Yield the zone workloads of the designs in input order as they complete."""
+        if self.pool is None:
+            for design in tqdm(designs):
+                yield evaluate_design(design, cache=self.cache, memo=self.memo, **self.context)
+        else:
+            yield from tqdm(self.pool.imap(_evaluate_design_worker, designs, chunksize=self.chunksize), total=len(designs))
+
+    def close(self, terminate=False):
+        """Shut down the pool, where the workers exit normally (e.g., writing their traces) unless `terminate`."""
+        if self.pool is None:
+            print("[%s] zone memo: %d hits, %d misses" % (arrow.now(), self.memo.hits, self.memo.misses), file=sys.stderr)
+        elif terminate:
+            self.pool.terminate()
+            self.pool.join()
+        else:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(terminate=exc_type is not None)
+        return False
+
+
+
+def evaluate_designs(designs, context, n_workers=1, chunksize=1):
+    """
+    Evaluate the designs serially (`n_workers=1`) or with a pool of worker processes, where 
+    `context` includes the read-only data (`year`, `beat_info`, `mu`, `t_beats`, `Tau`, `d_beats`, 
+    and `Dist`) and each task is a chunk of `chunksize` designs. The results are yielded in input 
+    order as they complete. Zone results are memoized per process, so larger chunks of adjacent 
+    designs share more zones.
+    """
+    with DesignEvaluator(context, n_workers=n_workers, chunksize=chunksize) as evaluator:
+        yield from evaluator.evaluate(designs)
+
+
+
+class MoveEvaluator(object):
+    """
+    Incremental Evaluation of Beat Moves
+
+    Keep the simulated zone workloads (except for the fixed zones) of a design and their variance,
+    so that a move only re-solves (or looks up in the memo) the two zones it changes, and its 
+    objective is scored in O(1) before being committed or rolled back.
+    """
+
+    def __init__(self, space, state, year, beat_info, mu, t_beats, Tau, d_beats, Dist, cache=None, memo=None):
+        self.space   = space
+        self.state   = state
+        self.context = { "year": year, "beat_info": beat_info, "mu": mu, "t_beats": t_beats, 
+            "Tau": Tau, "d_beats": d_beats, "Dist": Dist, "cache": cache, "memo": memo }
+        # objective index of each zone (-1 for the fixed zones)
+        self.obj_idx = np.full(len(space.zones), -1, dtype=np.int64)
+        zones        = [ z for z in range(len(space.zones)) if z not in space.fixed_zones ]
+        self.obj_idx[zones] = np.arange(len(zones))
+        workloads           = [ self._zone_workload(z) for z in zones ]
+        if not np.isfinite(workloads).all():
+            raise ValueError("the initial design has an infeasible zone.")
+        self.objective      = IncrementalVariance(workloads)
+        self.move           = None
+
+    def _zone_workload(self, zone):
+        beats = [ self.space.beats[b] for b in self.state.members(zone) ]
+        return zone_workload(beats, **self.context)
+
+    @property
+    def variance(self):
+        return self.objective.variance
+
+    def propose(self, move):
+        """Return the variance of the zone workloads after the move."""
+        token   = self.state.apply(move)
+        updates = { self.obj_idx[z]: self._zone_workload(z) for z in move[1:] if self.obj_idx[z] >= 0 }
+        self.state.undo(token)
+        self.move = move
+        if not np.isfinite(list(updates.values())).all():
+            # the move makes a zone infeasible, which can only be rolled back
+            self.objective.pending = None
+            return np.inf
+        return self.objective.propose(updates)
+
+    def commit(self):
+        """Apply the proposed move to the design."""
+        assert self.objective.pending is not None, "an infeasible move cannot be committed."
+        self.state.apply(self.move)
+        self.objective.commit()
+        self.move = None
+
+    def rollback(self):
+        """Discard the proposed move."""
+        self.objective.rollback()
+        self.move = None
+
+
+
+def local_search(evaluator, max_steps=100, on_move=None):
+    """
+    Greedy local search that repeatedly applies the first move (in the order of the design space)
+    decreasing the variance of the zone workloads, until no move improves or `max_steps` moves. 
+    `on_move(move, evaluator)` is called after each applied move if specified. Return the variances 
+    after each applied move.
+    """
+    variances = [ evaluator.variance ]
+    for step in range(max_steps):
+        for move in list(evaluator.space.moves(evaluator.state)):
+            if evaluator.propose(move) < variances[-1]:
+                evaluator.commit()
+                variances.append(evaluator.variance)
+                if on_move is not None:
+                    on_move(move, evaluator)
+                break
+            evaluator.rollback()
+        else:
+            break
+    return variances
+
+
+
+def screen_designs(designs, features, context, budget, batch_size=10, n_init=20, strategy="top-k", 
+    n_workers=1, chunksize=1, seed=0):
+    """
+    Evaluate a subset of the designs chosen by an online surrogate of the objective (the variance of
+    the zone workloads), i.e., after `n_init` random designs, repeatedly refit the surrogate on the
+    labels so far, and evaluate the `batch_size` remaining designs with the lowest predicted 
+    objective (`top-k`) or the most uncertain prediction (`uncertain`), until `budget` designs are 
+    evaluated. Return the indices of the evaluated designs (in the order of evaluation), their 
+    zone workloads, and the predicted objectives of all the designs by the final surrogate.
+    """
+    surrogate = OnlineSurrogate(features.shape[1])
+    remaining = np.random.RandomState(seed).permutation(len(designs))
+    batch     = remaining[:min(n_init, budget)]
+    evaluated, Ys = [], []
+    # the zone results (and the worker processes) are shared by all the batches
+    with DesignEvaluator(context, n_workers=n_workers, chunksize=chunksize) as evaluator:
+        while len(batch) > 0:
+            batch_Ys   = list(evaluator.evaluate([ designs[i] for i in batch ]))
+            # the infeasible designs are evaluated but never labeled
+            objs       = np.array([ design_objective(Y) for Y in batch_Ys ])
+            if np.isfinite(objs).any():
+                surrogate.add(features[batch[np.isfinite(objs)]], objs[np.isfinite(objs)])
+            evaluated += batch.tolist()
+            Ys        += batch_Ys
+            remaining  = remaining[~np.isin(remaining, batch)]
+            if len(remaining) == 0 or len(evaluated) >= budget:
+                break
+            mean, std  = surrogate.fit().predict(features[remaining], return_std=True)
+            batch      = remaining[select(mean, std, min(batch_size, budget - len(evaluated)), strategy)]
+            print("[%s] screened %d designs, best predicted objective %f" % \
+                (arrow.now(), len(evaluated), mean.min()), file=sys.stderr)
+    return evaluated, Ys, surrogate.fit().predict(features)
+
+
+
+def main_5(budget, batch_size=10, strategy="top-k", n_workers=1, chunksize=1, output="sim_output_screened.txt", 
+    imputation="mean"):
+    """Generate random valid designs and simulate the ones pre-screened by an online surrogate"""
+
+    beat_info, mu, t_beats, Tau, d_beats, Dist, old_design = data_preparation(imputation=imputation)
+    print("finish data preprocessing")
 
-    beat_info, mu, t_beats, Tau, d_beats, Dist, old_design = data_preparation()
+    new_designs = generate_design(old_design, min_rmv=2, n_rmv=4)
+    print("finish design generation")
+
+    validbeats = [ beat for z in old_design if z != "7" for beat in old_design[z] ]
+    features   = FeatureBuilder(validbeats).indicators(new_designs)
+    year       = '2017'
+    context    = { "year": year, "beat_info": beat_info, "mu": mu, 
+        "t_beats": t_beats, "Tau": Tau, "d_beats": d_beats, "Dist": Dist }
+    evaluated, Ys, approxs = screen_designs(new_designs, features, context, budget, batch_size=batch_size, 
+        strategy=strategy, n_workers=n_workers, chunksize=chunksize)
+
+    # design index, year, simulated objective, zone workloads, approximated objective
+    with open(output, "w") as f:
+        for i, Y in zip(evaluated, Ys):
+            f.write("%s\n" % ",".join([ str(i), str(year), str(design_objective(Y)) ] + [ str(y) for y in Y ] + [ str(approxs[i]) ]))
+    best = evaluated[int(np.argmin([ design_objective(Y) for Y in Ys ]))]
+    print("[%s] evaluated %d of %d designs, best design %d" % (arrow.now(), len(evaluated), len(new_designs), best), 
+        file=sys.stderr)
+
+
+
+def main_6(max_steps=100, output="sim_output_local.txt", resume=False, flush_every=10, imputation="mean"):
+    """
+    Improve a random subset of the current design by greedy local search over beat moves
+
+    Each move is scored by re-solving (or looking up in the memo) only the two zones it changes. 
+    The initial design and each applied move are appended to `<output>.part` (step, year, variance, 
+    zone workloads, and the moved beat with its old and new zone), along with a checkpoint 
+    `<output>.ckpt` every `flush_every` moves, and the search continues from the checkpoint if 
+    `resume` by replaying the recorded moves.
+    """
+
+    beat_info, mu, t_beats, Tau, d_beats, Dist, old_design = data_preparation(imputation=imputation)
+    print("finish data preprocessing")
+
+    # the initial design is regenerated from the random states recorded in the checkpoint
+    part_path, ckpt_path = output + ".part", output + ".ckpt"
+    ckpt   = load_checkpoint(ckpt_path) if resume else None
+    if ckpt is not None:
+        set_rng_state(ckpt["rng"])
+        print("[%s] resume from step %d" % (arrow.now(), ckpt["n_done"] - 1), file=sys.stderr)
+    state  = { "rng": rng_state() }
+
+    design = dropout_design(old_design, n=5)
+    state["designs"] = designs_hash([ design ])
+    if ckpt is not None and ckpt["designs"] != state["designs"]:
+        raise ValueError("the initial design differs from the one of the checkpoint (has the data changed?)")
+    space  = DesignSpace.from_graph(list(design.keys()), path=beats_graph_path)
+    dstate = space.encode(design)
+    # replay the moves recorded before the checkpoint (the first row is the initial design)
+    rows   = read_rows(part_path)[1:ckpt["n_done"]] if ckpt is not None else []
+    for row in rows:
+        dstate.apply((space.beat_idx[row[-3]], space.zone_idx[row[-2]], space.zone_idx[row[-1]]))
+
+    year      = '2017'
+    evaluator = MoveEvaluator(space, dstate, year, beat_info, mu, t_beats, Tau, d_beats, Dist, 
+        cache=StructureCache(cache_dir=structure_cache_dir), memo=ZoneMemo())
+    writer    = ResultWriter(part_path, ckpt_path, state, n_done=ckpt["n_done"] if ckpt is not None else 0, 
+        flush_every=flush_every)
+
+    def write_step(move, evaluator):
+        beat, from_zone, to_zone = ("", "", "") if move is None else \
+            (space.beats[move[0]], space.zones[move[1]], space.zones[move[2]])
+        writer.write([ str(writer.n_done), str(year), str(evaluator.variance) ] + 
+            [ str(y) for y in evaluator.objective.values ] + [ beat, from_zone, to_zone ])
+
+    if writer.n_done == 0:
+        write_step(None, evaluator)
+    variances = local_search(evaluator, max_steps=max(max_steps - len(rows), 0), on_move=write_step)
+    writer.close()
+    print("[%s] variance %f after %d moves" % (arrow.now(), variances[-1], writer.n_done - 1), file=sys.stderr)
+
+    os.replace(part_path, output)
+    os.remove(ckpt_path)
+
+
+
+def main_4(n_workers=1, chunksize=1, output="sim_output.txt", resume=False, flush_every=10, imputation="mean"):
+    """
+    Generate random valid design and get corresponding simulation output
+
+    The output of each design is appended to `<output>.part` as it is evaluated, along with a 
+    checkpoint `<output>.ckpt` every `flush_every` designs, and the run continues from the 
+    checkpoint if `resume`. The final output (with the approximated objectives) is written once.
+    """
+
+    beat_info, mu, t_beats, Tau, d_beats, Dist, old_design = data_preparation(imputation=imputation)
     print("finish data preprocessing")
 
+    # the designs are regenerated from the random states recorded in the checkpoint
+    part_path, ckpt_path = output + ".part", output + ".ckpt"
+    ckpt        = load_checkpoint(ckpt_path) if resume else None
+    if ckpt is not None:
+        set_rng_state(ckpt["rng"])
+        print("[%s] resume from design %d" % (arrow.now(), ckpt["n_done"]), file=sys.stderr)
+    state       = { "rng": rng_state() }
+
     new_designs = generate_design(old_design, min_rmv=2, n_rmv=4)
     print("finish design generation")
+    state["designs"] = designs_hash(new_designs)
+    if ckpt is not None and ckpt["designs"] != state["designs"]:
+        raise ValueError("the designs differ from the designs of the checkpoint (has the data changed?)")
 
     validbeats = []
     for z in old_design:
@@ -239,75 +789,117 @@ def main_4():
             validbeats += [ beat for beat in old_design[z] ]
     print(validbeats)
 
-    Xs = []
-    Ys = []
-    lY = []
-    lX = []
     year = '2017'
-    for design in tqdm(new_designs):
-        Y = []
-        for zone in design:
-            if zone == "7":
-                continue
-            # build operations model
-            beats   = design[zone]
-            n_atoms = len(beats)
-            Eta     = np.array([ beat_info[beat][year]["count"] for beat in beats ])
-            Lam     = np.array([ beat_info[beat][year]["count"] for beat in beats ])
-            Lam     = Lam / Lam.sum()
-            T       = matrix_selection(Tau, beats, t_beats)
-            P       = matrix_selection(Dist, beats, d_beats).argsort()
-            hq    = HypercubeQ(n_atoms, Lam=Lam, T=T, P=P, cap="inf", max_iter=10, q_len=100)
-            avg_T = hq.Tu               
-            Frac  = hq.Rho_1 + hq.Rho_2
-            Y_hat = (Frac * Eta.sum() * (avg_T + mu)).sum()
-            Y.append(Y_hat)
-        output = [ str(year), str(stats.variance(Y)) ] + [ str(y) for y in Y ]
-        Ys.append(output)
-        # build approximation model
-        zones = list(design.keys())
-        x = np.zeros((len(validbeats), 6)) 
-        for z in design:
-            if z == "7":
-                continue
-            for beat in validbeats:
-                if beat in design[z]:
-                    x[validbeats.index(beat), zones.index(z)] = 1
-        # x = np.zeros(len(validbeats)) 
-        # for beat in validbeats:
-        #     x[validbeats.index(beat)] = beat_info[beat][year]["count"] * Tau[t_beats.index(beat),:].sum()
-        lY.append(stats.variance(Y))
-        lX.append(x.flatten())
-
-    with open("sim_output.txt", "w") as f:
-        for Y in Ys:
-            f.write("%s\n" % ",".join(Y))
+    context = { "year": year, "beat_info": beat_info, "mu": mu, 
+        "t_beats": t_beats, "Tau": Tau, "d_beats": d_beats, "Dist": Dist }
+    writer  = ResultWriter(part_path, ckpt_path, state, n_done=ckpt["n_done"] if ckpt is not None else 0, 
+        flush_every=flush_every)
+    for Y in evaluate_designs(new_designs[writer.n_done:], context, n_workers=n_workers, chunksize=chunksize):
+        writer.write([ str(year), str(design_objective(Y)) ] + [ str(y) for y in Y ])
+    writer.close()
+
+    Ys = read_rows(part_path)
+    # build approximation model (sparse indicators of the beats in the zones of each design)
+    builder = FeatureBuilder(validbeats)
+    lX      = builder.indicators(new_designs[:len(Ys)])
+    lY = np.array([ float(row[1]) for row in Ys ])
+    # the designs with an infeasible zone are left out of the fit (but still approximated)
+    feasible    = np.isfinite(lY)
+    if not feasible.all():
+        print("[%s] %d infeasible designs left out of the approximation" % (arrow.now(), (~feasible).sum()), 
+            file=sys.stderr)
+    lY_min, lY_max = lY[feasible].min(), lY[feasible].max()
 
     # linear regression model
-    lX = np.array(lX)
-    nlX = (lX - lX.min()) / (lX.max() - lX.min())
-    lY = np.array(lY)
-    nlY = (lY - lY.min()) / (lY.max() - lY.min())
-
-    # X       = sm.add_constant(X)
-    model   = sm.OLS(nlY, nlX)
-    results = model.fit()
-    approxs = results.predict(nlX)
-    approxs = approxs * (lY.max() - lY.min()) + lY.min()
-    approxs = np.array(approxs) #.reshape([len(new_designs), 6]).sum(axis=1)
-    print(results.summary())
+    nlX, _, _   = minmax_scale(lX)
+    nlY         = (lY[feasible] - lY_min) / (lY_max - lY_min)
+
+    # X       = add_constant(X)
+    W, summary  = fit_sparse(nlX[feasible], nlY, inference=True)
+    approxs     = nlX.dot(W)
+    approxs     = approxs * (lY_max - lY_min) + lY_min
+    # the indicators are indexed by the position of the zones in the designs (see `FeatureBuilder`)
+    print(summary_table(summary, builder.indicator_names(list(old_design)[:6])))
     print(approxs)
 
-    with open("sim_output.txt", "w") as f:
+    with open(output, "w") as f:
         for i in range(len(Ys)):
             Ys[i].append(str(approxs[i]))
             f.write("%s\n" % ",".join(Ys[i]))
+    os.remove(part_path)
+    os.remove(ckpt_path)
+
+
+
+def main_7(n_designs=20, n_workers=2, chunksize=1, output="sim_output_check.txt", imputation="mean"):
+    """
+    Check that the parallel evaluation of designs writes the same output as the serial one
+
+    The first `n_designs` random designs (as in `main_4`) are evaluated serially and by a pool of 
+    `n_workers` processes, where the rows of the designs are written to `<output>.serial` and 
+    `<output>.parallel` respectively, and both files have to be byte-identical.
+    """
+
+    beat_info, mu, t_beats, Tau, d_beats, Dist, old_design = data_preparation(imputation=imputation)
+    new_designs = generate_design(old_design, min_rmv=2, n_rmv=4)[:n_designs]
+
+    year    = '2017'
+    context = { "year": year, "beat_info": beat_info, "mu": mu, 
+        "t_beats": t_beats, "Tau": Tau, "d_beats": d_beats, "Dist": Dist }
+    paths   = []
+    for workers, suffix in [ (1, "serial"), (n_workers, "parallel") ]:
+        paths.append("%s.%s" % (output, suffix))
+        with open(paths[-1], "w") as f:
+            for Y in evaluate_designs(new_designs, context, n_workers=workers, chunksize=chunksize):
+                f.write("%s\n" % ",".join([ str(year), str(design_objective(Y)) ] + [ str(y) for y in Y ]))
+    if not filecmp.cmp(paths[0], paths[1], shallow=False):
+        raise RuntimeError("the outputs of the serial and parallel evaluations differ (%s and %s)" % tuple(paths))
+    print("[%s] the outputs of the serial and parallel evaluations of %d designs are identical" % 
+        (arrow.now(), len(new_designs)))
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate random valid designs and evaluate them.")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=1, help="number of designs per task")
+    parser.add_argument("--output", default=None, 
+        help="path of the simulation output (sim_output.txt, sim_output_screened.txt for the screening, "
+        "or sim_output_local.txt for the local search)")
+    parser.add_argument("--resume", action="store_true", help="resume from the checkpoint of an interrupted run")
+    parser.add_argument("--flush-every", type=int, default=10, help="number of designs between checkpoints")
+    parser.add_argument("--screen", default=None, choices=["top-k", "uncertain"], 
+        help="only simulate the designs pre-screened by an online surrogate")
+    parser.add_argument("--budget", type=int, default=100, help="number of designs simulated when screening")
+    parser.add_argument("--local-search", action="store_true", 
+        help="improve the current design by greedy local search instead of evaluating random designs")
+    parser.add_argument("--max-steps", type=int, default=100, help="maximum number of moves of the local search")
+    parser.add_argument("--batch-size", type=int, default=10, help="number of designs simulated per refit")
+    parser.add_argument("--check-parallel", type=int, default=None, metavar="N_DESIGNS",
+        help="evaluate the first N_DESIGNS random designs both serially and by --workers (at least 2) processes, "
+        "and check that both outputs are byte-identical")
+    parser.add_argument("--imputation", default="mean", choices=["mean", "shortest-path"], 
+        help="imputation of the missing travel times")
+    parser.add_argument("--trace", default=None, 
+        help="write a Chrome trace of the spans to this path (and of each worker process to <path>.<pid>)")
+    args = parser.parse_args()
+
+    if args.trace is not None:
+        tracing.enable(args.trace)
+
     np.random.seed(2)
-    main_4()
+    if args.check_parallel is not None:
+        main_7(args.check_parallel, n_workers=max(args.workers, 2), chunksize=args.chunksize, 
+            output=args.output or "sim_output_check.txt", imputation=args.imputation)
+    elif args.local_search:
+        main_6(max_steps=args.max_steps, output=args.output or "sim_output_local.txt", resume=args.resume, 
+            flush_every=args.flush_every, imputation=args.imputation)
+    elif args.screen is not None:
+        main_5(args.budget, batch_size=args.batch_size, strategy=args.screen, n_workers=args.workers, 
+            chunksize=args.chunksize, output=args.output or "sim_output_screened.txt", imputation=args.imputation)
+    else:
+        main_4(n_workers=args.workers, chunksize=args.chunksize, output=args.output or "sim_output.txt", 
+            resume=args.resume, flush_every=args.flush_every, imputation=args.imputation)
 
     # import matplotlib.pyplot as plt
     # from matplotlib.backends.backend_pdf import PdfPages